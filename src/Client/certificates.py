@@ -2,29 +2,42 @@ from log import logger
 from lib import *
 from OpenSSL import crypto
 from cryptography.hazmat.backends import default_backend
-from cryptography.x509 import oid, extensions
+from cryptography.hazmat.primitives import serialization
+from cryptography.x509 import oid, extensions, ocsp
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding
 from datetime import datetime, timedelta
-from subprocess import check_output, DEVNULL
-import wget
+import urllib.request
+import urllib.parse
+import urllib.error
+import hashlib
+import calendar
+from collections import Counter
+import threading
+import fcntl
+import random
+import time
 import os
 import shutil
 import logging
+import json
+
+
+class EndpointUnavailable(Exception):
+    pass
 
 
 # Only accepts OpenSSL X509 Objects
 class X509Certificates:
     @classmethod
-    def download_crl(cls, cert, download_type):
-        url = download_type(cert)
-        if url is None:
-            return None, None
-
-        crl_download = wget.download(url, out=CRLS_DIR[:-1])
+    def get_crl_filename(cls, url):
+        name = os.path.basename(urllib.parse.urlparse(url).path)
+        return hashlib.sha256(url.encode()).hexdigest()[:16] + '_' + name
 
-        with open(crl_download, 'rb') as f:
-            crl = crypto.load_crl(crypto.FILETYPE_ASN1, f.read())
-
-        return crl, crl_download
+    @classmethod
+    def get_revoked_serials(cls, crl):
+        return frozenset(revoked.serial_number
+                         for revoked in crl.to_cryptography())
 
     @classmethod
     def get_cert_id(cls, cert, subject_notissuer=True):
@@ -37,6 +50,37 @@ class X509Certificates:
 
         return cert_id
 
+    @classmethod
+    def get_fingerprint(cls, cert):
+        return cert.digest('sha256').decode()
+
+    @classmethod
+    def get_key_identifier(cls, cert, subject_notissuer=True):
+        try:
+            if subject_notissuer:
+                return cert.to_cryptography().extensions \
+                    .get_extension_for_oid(
+                        oid.ExtensionOID.SUBJECT_KEY_IDENTIFIER).value.digest
+
+            return cert.to_cryptography().extensions.get_extension_for_oid(
+                oid.ExtensionOID.AUTHORITY_KEY_IDENTIFIER).value.key_identifier
+        except extensions.ExtensionNotFound:
+            return None
+
+    @classmethod
+    def is_self_signed(cls, cert):
+        return cert.get_subject() == cert.get_issuer()
+
+    @classmethod
+    def is_ca_cert(cls, cert):
+        try:
+            ext = cert.to_cryptography().extensions.get_extension_for_oid(
+                oid.ExtensionOID.BASIC_CONSTRAINTS)
+            return ext.value.ca
+        except extensions.ExtensionNotFound:
+            # Old root certificates have no basic constraints
+            return X509Certificates.is_self_signed(cert)
+
     @classmethod
     def get_extension(cls, cert, short_name):
         for i in range(0, cert.get_extension_count()):
@@ -75,22 +119,551 @@ class X509Certificates:
             return None
 
     @classmethod
-    def get_ocsp_response(cls, cert_path, issuer_path, ocsp_url):
+    def verify_signature(cls, public_key, signature, data, hash_algorithm):
+        if isinstance(public_key, ec.EllipticCurvePublicKey):
+            public_key.verify(signature, data, ec.ECDSA(hash_algorithm))
+        else:
+            public_key.verify(signature, data, padding.PKCS1v15(),
+                              hash_algorithm)
+
+    @classmethod
+    def get_ocsp_responder(cls, response, issuer):
+        """Certificate that signed an OCSP response: the issuer itself, or
+        a responder certificate issued by it for OCSP signing.
+        """
+        now = datetime.utcnow()
+        for cert in response.certificates:
+            if cert.issuer != issuer.subject or \
+                    not cert.not_valid_before <= now <= cert.not_valid_after:
+                continue
+
+            X509Certificates.verify_signature(
+                issuer.public_key(), cert.signature,
+                cert.tbs_certificate_bytes, cert.signature_hash_algorithm)
+
+            try:
+                usage = cert.extensions.get_extension_for_oid(
+                    oid.ExtensionOID.EXTENDED_KEY_USAGE).value
+            except extensions.ExtensionNotFound:
+                continue
+
+            if oid.ExtendedKeyUsageOID.OCSP_SIGNING in usage:
+                return cert
+
+        return issuer
+
+    def request_ocsp_status(self, cert, issuer, ocsp_url):
+        """Ask an OCSP responder for the status of a certificate.
+        Returns whether it is good and until when the answer holds.
+        """
+        cert = cert.to_cryptography()
+        issuer = issuer.to_cryptography()
+
+        request = ocsp.OCSPRequestBuilder().add_certificate(
+            cert, issuer, hashes.SHA1()).build()
+        http_request = urllib.request.Request(
+            ocsp_url,
+            data=request.public_bytes(serialization.Encoding.DER),
+            headers={'Content-Type': 'application/ocsp-request'}
+        )
+        with self.open_url(http_request) as http_response:
+            response = ocsp.load_der_ocsp_response(http_response.read())
+
+        if response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+            raise ValueError("OCSP responder error: %r"
+                             % response.response_status)
+
+        # The certificate is identified by its serial number and the hashes
+        # of the name and key of its issuer
+        cert_id = ocsp.OCSPRequestBuilder().add_certificate(
+            cert, issuer, response.hash_algorithm).build()
+        if response.serial_number != cert.serial_number \
+                or response.issuer_name_hash != cert_id.issuer_name_hash \
+                or response.issuer_key_hash != cert_id.issuer_key_hash:
+            raise ValueError("OCSP response for another certificate")
+
+        responder = X509Certificates.get_ocsp_responder(response, issuer)
+        X509Certificates.verify_signature(
+            responder.public_key(), response.signature,
+            response.tbs_response_bytes, response.signature_hash_algorithm)
+
+        # Replayed responses are no longer current
+        now = datetime.utcnow()
+        skew = timedelta(seconds=OCSP_CLOCK_SKEW)
+        next_update = response.next_update
+        if next_update is None:
+            next_update = response.this_update + timedelta(
+                seconds=OCSP_DEFAULT_TTL)
+
+        if response.this_update > now + skew or next_update < now - skew:
+            raise ValueError("OCSP response out of date: %s - %s"
+                             % (response.this_update, next_update))
+
+        return response.certificate_status == ocsp.OCSPCertStatus.GOOD, \
+            next_update
+
+    def get_ocsp_response(self, cert, issuer, ocsp_url):
+        """Status of a certificate from the OCSP cache or its responder.
+        Concurrent checks of the same certificate share one request.
+        """
+        key = (X509Certificates.get_cert_id(cert, False),
+               cert.get_serial_number())
+
+        while True:
+            with self.lock:
+                cached = self.ocsp_cache.get(key)
+                if cached is not None \
+                        and cached['next_update'] > datetime.utcnow():
+                    logger.log(logging.DEBUG, "[Cache] OCSP: %r" % (key,))
+                    return cached['good']
+
+                pending = self.ocsp_pending.get(key)
+                if pending is None:
+                    pending = self.ocsp_pending[key] = threading.Event()
+                    break
+
+            # Someone else is asking for it
+            pending.wait()
+
         try:
-            response = check_output(
-                ['openssl', 'ocsp', '-issuer', issuer_path, '-cert', cert_path,
-                 '-url', ocsp_url, '-CAfile', CERTS_DIR + 'ca'],
-                stderr=DEVNULL
-            )
+            good, next_update = self.request_ocsp_status(
+                cert, issuer, ocsp_url)
 
-            for line in response.decode().split('\n'):
-                if cert_path in line:
-                    r = line.split(':')[1].strip()
-                    return True if r == 'good' else False
+            with self.lock:
+                self.ocsp_cache[key] = {
+                    'good': good,
+                    'next_update': next_update
+                }
 
+            if cached is not None and cached['good'] != good:
+                self.invalidate_validations(key[0])
+
+            self.count_outcome('fetched')
+            return good
+        except Exception as e:
+            logger.log(logging.DEBUG, "Cannot get OCSP status of %r: %s"
+                       % (key, e))
+
+            if cached is not None and datetime.utcnow() <= \
+                    self.usable_until(cached['next_update']):
+                logger.log(logging.DEBUG, "[Stale] OCSP: %r" % (key,))
+                self.count_outcome('served_stale')
+                return cached['good']
+
+            self.count_outcome('failed_closed')
             return False
+        finally:
+            with self.lock:
+                del self.ocsp_pending[key]
+            pending.set()
+
+    def load_validation_cache(self):
+        """Validation results saved to disk, by this or other processes.
+        """
+        try:
+            with open(VALIDATION_CACHE) as f:
+                entries = json.loads(f.read())
+        except FileNotFoundError:
+            return {}
         except Exception:
-            return False
+            logging.exception("Cannot load validation cache")
+            return {}
+
+        now = time.time()
+        return {fingerprint: entry for fingerprint, entry in entries.items()
+                if entry['expires'] > now}
+
+    def save_validation_cache(self):
+        """Merge the validation results changed since the last save into the
+        ones saved by every process, by fingerprint, and take theirs,
+        including their removals, in place of the cached ones.
+        Called periodically, so validations never wait for the disk.
+        """
+        with self.lock:
+            changes = self.validation_changes
+            self.validation_changes = {}
+
+        try:
+            # Other processes merge theirs too
+            with open(VALIDATION_CACHE + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX if changes else fcntl.LOCK_SH)
+
+                entries = self.load_validation_cache()
+                for fingerprint, entry in changes.items():
+                    if entry is None:
+                        entries.pop(fingerprint, None)
+                    else:
+                        entries[fingerprint] = entry
+
+                if changes:
+                    tmp = VALIDATION_CACHE + '.tmp'
+                    with open(tmp, 'w') as f:
+                        f.write(json.dumps(entries))
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                    os.replace(tmp, VALIDATION_CACHE)
+        except Exception:
+            # Saved along with the next ones
+            with self.lock:
+                for fingerprint, entry in changes.items():
+                    self.validation_changes.setdefault(fingerprint, entry)
+            raise
+
+        with self.lock:
+            # Results changed meanwhile are saved next time
+            for fingerprint, entry in self.validation_changes.items():
+                if entry is None:
+                    entries.pop(fingerprint, None)
+                else:
+                    entries[fingerprint] = entry
+            self.valid_certs = entries
+
+        if changes:
+            logger.log(logging.DEBUG, "Saved %d validation results"
+                       % len(changes))
+
+    def cached_validation(self, fingerprint):
+        """Whether a certificate was found valid, or None if unknown.
+        """
+        with self.lock:
+            entry = self.valid_certs.get(fingerprint)
+
+        if entry is None or entry['expires'] <= time.time():
+            return None
+
+        return entry['valid']
+
+    def cache_validation(self, fingerprint, valid, chain=()):
+        """Keep the result of validating a certificate, until the next save.
+        Valid results never outlive the certificates of the chain nor their
+        revocation data.
+        """
+        if valid:
+            expires = self.chain_expiry(chain)
+        else:
+            expires = time.time() + VALIDATION_NEGATIVE_TTL
+
+        entry = {
+            'valid': valid,
+            'expires': expires,
+            'issuers': sorted(set(
+                X509Certificates.get_cert_id(cert, False) for cert in chain))
+        }
+
+        with self.lock:
+            self.valid_certs[fingerprint] = entry
+            self.validation_changes[fingerprint] = entry
+
+    def invalidate_validations(self, issuer=None):
+        """Forget the results of validating chains through an issuer,
+        after its revocation data changed, or all of them.
+        """
+        with self.lock:
+            for fingerprint in [fingerprint for fingerprint, entry
+                                in self.ca_chains.items()
+                                if issuer is None
+                                or issuer in entry['issuers']]:
+                del self.ca_chains[fingerprint]
+
+            stale = [fingerprint for fingerprint, entry
+                     in self.valid_certs.items()
+                     if issuer is None or issuer in entry['issuers']]
+            if not stale:
+                return
+
+            logger.log(logging.DEBUG, "Invalidating %d validations of %r"
+                       % (len(stale), issuer))
+            for fingerprint in stale:
+                del self.valid_certs[fingerprint]
+                self.validation_changes[fingerprint] = None
+
+    def chain_expiry(self, chain):
+        """Until when a chain checked now can be trusted without checking
+        it again.
+        """
+        expires = [time.time() + VALIDATION_TTL]
+        for cert in chain:
+            expires.append(calendar.timegm(
+                cert.to_cryptography().not_valid_after.timetuple()))
+            expires.append(self.revocation_expiry(cert))
+
+        return min(e for e in expires if e is not None)
+
+    def revocation_expiry(self, cert):
+        """When the revocation data used to check a certificate goes out of
+        date, or None if it wasn't checked.
+        """
+        issuer = X509Certificates.get_cert_id(cert, False)
+
+        with self.lock:
+            status = self.ocsp_cache.get((issuer, cert.get_serial_number()))
+            if status is not None:
+                next_update = status['next_update']
+            elif issuer in self.crls:
+                next_update = self.crls[issuer]['crl'] \
+                    .to_cryptography().next_update
+            else:
+                return None
+
+        return calendar.timegm(next_update.timetuple())
+
+    def load_crl_cache(self):
+        """Read the metadata of the CRLs downloaded before, by URL.
+        """
+        if not os.path.exists(CRLS_INDEX):
+            return
+
+        try:
+            with open(CRLS_INDEX) as f:
+                self.crl_cache = json.loads(f.read())
+        except:
+            logging.exception("Cannot load CRL cache index")
+
+    def save_crl_cache(self):
+        tmp = CRLS_INDEX + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.crl_cache))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, CRLS_INDEX)
+
+    def load_cached_crl(self, url):
+        entry = self.crl_cache.get(url)
+        if entry is None or not os.path.exists(entry['path']):
+            return None
+
+        try:
+            with open(entry['path'], 'rb') as f:
+                return crypto.load_crl(crypto.FILETYPE_ASN1, f.read())
+        except crypto.Error:
+            logger.log(logging.DEBUG, "Invalid cached CRL: %r" % url)
+            return None
+
+    def count_outcome(self, outcome):
+        with self.lock:
+            self.revocation_stats[outcome] += 1
+
+    def usable_until(self, next_update):
+        """Until when revocation data may be used, given its next update.
+        """
+        if REVOCATION_POLICY == 'stale':
+            return next_update + timedelta(seconds=STALE_GRACE)
+
+        return next_update
+
+    def open_url(self, request):
+        """Open a CRL or OCSP request, with the timeout of its endpoint and
+        unless the endpoint keeps failing.
+        """
+        host = urllib.parse.urlparse(request.full_url).netloc
+
+        with self.lock:
+            endpoint = self.endpoints.setdefault(
+                host, {'failures': 0, 'open_until': 0})
+            if endpoint['failures'] >= BREAKER_FAILURES \
+                    and time.time() < endpoint['open_until']:
+                self.revocation_stats['breaker_open'] += 1
+                raise EndpointUnavailable(host)
+
+        try:
+            response = urllib.request.urlopen(
+                request,
+                timeout=REVOCATION_TIMEOUTS.get(host, REVOCATION_TIMEOUT))
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                self.endpoint_failed(host, endpoint)
+            raise
+        except Exception:
+            self.endpoint_failed(host, endpoint)
+            raise
+
+        with self.lock:
+            endpoint['failures'] = 0
+
+        return response
+
+    def endpoint_failed(self, host, endpoint):
+        with self.lock:
+            endpoint['failures'] += 1
+            self.revocation_stats['fetch_error'] += 1
+
+            if endpoint['failures'] >= BREAKER_FAILURES:
+                logger.log(logging.DEBUG, "Skipping endpoint %r for %d "
+                           "seconds" % (host, BREAKER_COOLDOWN))
+                endpoint['open_until'] = time.time() + BREAKER_COOLDOWN
+
+    def stale_crl(self, url, crl, error):
+        """Fall back to the cached copy of a CRL that can't be fetched,
+        as long as the policy allows it.
+        """
+        if crl is not None and datetime.today() <= \
+                self.usable_until(crl.to_cryptography().next_update):
+            logger.log(logging.DEBUG, "[Stale] CRL: %r (%s)" % (url, error))
+            self.count_outcome('served_stale')
+            return crl, self.crl_cache[url]['path']
+
+        self.count_outcome('failed_closed')
+        raise error
+
+    def fetch_crl(self, url, prefetch=False):
+        """Get a CRL from the cache, while it is not stale, or else download
+        it, sending a conditional request if there is a cached copy.
+        When prefetching, the cached copy is always checked for updates.
+        """
+        if url is None:
+            return None, None
+
+        crl = self.load_cached_crl(url)
+        if crl is not None and not prefetch and datetime.today() <= \
+                crl.to_cryptography().next_update:
+            logger.log(logging.DEBUG, "[Cache] CRL: %r" % url)
+            return crl, self.crl_cache[url]['path']
+
+        headers = {}
+        if crl is not None:
+            entry = self.crl_cache[url]
+            if entry.get('etag') is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified') is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            request = urllib.request.Request(url, headers=headers)
+            with self.open_url(request) as response:
+                data = response.read()
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+
+            new_crl = crypto.load_crl(crypto.FILETYPE_ASN1, data)
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or crl is None:
+                return self.stale_crl(url, crl, e)
+
+            logger.log(logging.DEBUG, "CRL not modified: %r" % url)
+            self.count_outcome('not_modified')
+            return crl, self.crl_cache[url]['path']
+        except Exception as e:
+            return self.stale_crl(url, crl, e)
+
+        logger.log(logging.DEBUG, "Downloaded CRL: %r" % url)
+        self.count_outcome('fetched')
+        crl = new_crl
+
+        path = CRLS_DIR + X509Certificates.get_crl_filename(url)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+        with self.lock:
+            self.crl_cache[url] = {
+                'path': path,
+                'etag': etag,
+                'last_modified': last_modified,
+                'next_update': crl.to_cryptography().next_update.isoformat()
+            }
+            self.save_crl_cache()
+
+        return crl, path
+
+    @classmethod
+    def crl_entry(cls, crl, path):
+        return {
+            'path': path,
+            'crl': crl,
+            'revoked': X509Certificates.get_revoked_serials(crl)
+        }
+
+    def load_issuer_crls(self, issuer, cert):
+        """Get the CRL and delta CRL of an issuer for the first time.
+        Returns None if the issuer has no CRL.
+        """
+        urls = {
+            'crl': X509Certificates.get_crl_url(cert),
+            'delta': X509Certificates.get_delta_url(cert)
+        }
+
+        crl, crl_path = self.fetch_crl(urls['crl'])
+        if crl is None:
+            return None
+
+        entry = X509Certificates.crl_entry(crl, crl_path)
+        entry['urls'] = urls
+        entry['delta'] = None
+
+        delta, delta_path = self.fetch_crl(urls['delta'])
+        if delta is not None:
+            entry['delta'] = X509Certificates.crl_entry(delta, delta_path)
+
+        with self.lock:
+            self.crls[issuer] = entry
+            self.store = None
+
+        return entry
+
+    def start_crl_refresher(self):
+        self.crl_refresher = threading.Thread(target=self.refresh_crls,
+                                              daemon=True)
+        self.crl_refresher.start()
+
+    def refresh_crls(self):
+        """Keep the known CRLs up to date, fetching them a while before
+        their next update, so validations never wait for a download.
+        """
+        while True:
+            time.sleep(CRL_REFRESH_INTERVAL)
+
+            for issuer, entry in list(self.crls.items()):
+                try:
+                    self.refresh_issuer_crls(issuer, entry)
+                except Exception:
+                    logging.exception("Cannot refresh CRLs of %r" % issuer)
+
+            with self.lock:
+                stats = dict(self.revocation_stats)
+            logger.log(logging.DEBUG, "Revocation checks: %r" % stats)
+
+            try:
+                self.save_validation_cache()
+            except Exception:
+                logging.exception("Cannot save validation cache")
+
+    def refresh_issuer_crls(self, issuer, entry):
+        # Spread the downloads of CRLs sharing the same next update
+        deadline = datetime.today() + timedelta(
+            seconds=CRL_PREFETCH
+            + random.uniform(0, CRL_PREFETCH_JITTER))
+
+        updates = {}
+        for kind in ['crl', 'delta']:
+            current = entry if kind == 'crl' else entry['delta']
+            if entry['urls'][kind] is None or (current is not None and
+                    current['crl'].to_cryptography().next_update > deadline):
+                continue
+
+            crl, path = self.fetch_crl(entry['urls'][kind], prefetch=True)
+            if crl is not None and (current is None or
+                    crl.to_cryptography().last_update !=
+                    current['crl'].to_cryptography().last_update):
+                logger.log(logging.DEBUG, "Refreshed %s of %r" % (kind, issuer))
+                updates[kind] = X509Certificates.crl_entry(crl, path)
+
+        if not updates:
+            return
+
+        # Swap in the new revocation index at once
+        entry = dict(entry)
+        if 'crl' in updates:
+            entry.update(updates['crl'])
+        if 'delta' in updates:
+            entry['delta'] = updates['delta']
+
+        with self.lock:
+            self.crls[issuer] = entry
+            self.store = None
+
+        self.invalidate_validations(issuer)
 
     @classmethod
     def create_folders(cls):
@@ -104,18 +677,37 @@ class X509Certificates:
 
         os.makedirs(USER_CERTS_DIR)
 
-        # Reset CRLs dir
-        if os.path.exists(CRLS_DIR):
-            shutil.rmtree(CRLS_DIR)
-
-        os.makedirs(CRLS_DIR)
+        # Downloaded CRLs are kept between runs
+        if not os.path.exists(CRLS_DIR):
+            os.makedirs(CRLS_DIR)
 
     def __init__(self):
         self.crls = {}
         self.certs = {}
         self.valid_certs = {}
+        self.validation_changes = {}
+        self.crl_cache = {}
+        self.lock = threading.RLock()
+        self.ocsp_cache = {}
+        self.ocsp_pending = {}
+        self.endpoints = {}
+        self.revocation_stats = Counter()
+
+        # Store with the CA certificates and CRLs, used to verify chains.
+        # Built on first use and whenever CRLs change.
+        self.ca_certs = {}
+        self.store = None
+
+        # CA certificates by subject name and key identifier, and the
+        # checked chains of each of them, by fingerprint
+        self.ca_index = {'subject': {}, 'ski': {}}
+        self.ca_chains = {}
+        self.store_expiry = None
 
         X509Certificates.create_folders()
+        self.load_crl_cache()
+        self.valid_certs = self.load_validation_cache()
+        self.start_crl_refresher()
 
         self.import_certs(CERTS_DIR)
         self.import_certs(USER_CERTS_DIR)
@@ -177,6 +769,116 @@ class X509Certificates:
             if cert_id not in self.certs.keys():
                 self.certs[cert_id] = {'cert': cert, 'path': path}
 
+                if X509Certificates.is_ca_cert(cert):
+                    self.add_ca_cert(cert_id, cert)
+
+    def add_ca_cert(self, cert_id, cert):
+        self.ca_certs[cert_id] = cert
+
+        with self.lock:
+            self.ca_index['subject'].setdefault(
+                cert.get_subject().der(), []).append(cert)
+
+            ski = X509Certificates.get_key_identifier(cert)
+            if ski is not None:
+                self.ca_index['ski'].setdefault(ski, []).append(cert)
+
+        if self.store is not None:
+            self.store.add_cert(cert)
+
+    def find_issuer(self, cert):
+        """CA certificate that issued cert, found by its authority key
+        identifier or else by its issuer name.
+        """
+        name = cert.get_issuer().der()
+        aki = X509Certificates.get_key_identifier(cert, False)
+
+        with self.lock:
+            candidates = self.ca_index['ski'].get(aki, []) \
+                if aki is not None else []
+            if not candidates:
+                candidates = self.ca_index['subject'].get(name, [])
+
+            candidates = [c for c in candidates
+                          if c.get_subject().der() == name]
+
+        # Prefer the ones still valid, when a CA was renewed
+        candidates.sort(key=lambda c: c.has_expired())
+        return candidates[0] if candidates else None
+
+    def get_ca_chain(self, ca, depth=0):
+        """CA certificates from ca up to its root, not included, checked for
+        expiration and revocation. Returns None if any is not valid.
+
+        Chains are cached until any of their certificates expires, or its
+        revocation data goes out of date.
+        """
+        fingerprint = X509Certificates.get_fingerprint(ca)
+        with self.lock:
+            cached = self.ca_chains.get(fingerprint)
+
+        if cached is not None and cached['expires'] > time.time():
+            return cached['chain']
+
+        if X509Certificates.is_self_signed(ca):
+            chain = []
+        else:
+            issuer = self.find_issuer(ca)
+            if issuer is None or depth >= MAX_CHAIN_DEPTH \
+                    or not self.check_expiration_or_revoked({'cert': ca}):
+                return None
+
+            parent = self.get_ca_chain(issuer, depth + 1)
+            if parent is None:
+                return None
+
+            chain = [ca] + parent
+
+        with self.lock:
+            self.ca_chains[fingerprint] = {
+                'chain': chain,
+                'expires': self.chain_expiry(chain),
+                'issuers': set(X509Certificates.get_cert_id(c, False)
+                               for c in chain)
+            }
+
+        return chain
+
+    def get_store(self):
+        with self.lock:
+            return self.build_store()
+
+    def build_store(self):
+        if self.store is not None and datetime.today() <= self.store_expiry:
+            return self.store
+
+        crls = []
+        for subject in self.crls.keys():
+            crls.append(self.crls[subject]['crl'])
+            if self.crls[subject]['delta'] is not None:
+                crls.append(self.crls[subject]['delta']['crl'])
+
+        store = crypto.X509Store()
+        for cert in self.ca_certs.values():
+            store.add_cert(cert)
+
+        for crl in crls:
+            store.add_crl(crl)
+
+        # The store rejects outdated CRLs, so while any is served stale,
+        # revocation is only checked against the revoked serials
+        next_updates = [crl.to_cryptography().next_update for crl in crls]
+        if all(datetime.today() <= update for update in next_updates):
+            store.set_flags(crypto.X509StoreFlags.CRL_CHECK_ALL)
+            self.store_expiry = min(next_updates, default=datetime.max)
+        else:
+            logger.log(logging.DEBUG, "Outdated CRLs, store without CRL checks")
+            self.store_expiry = datetime.today() + timedelta(
+                seconds=CRL_REFRESH_INTERVAL)
+
+        self.store = store
+        return self.store
+
     def check_expiration_or_revoked(self, cert_entry):
         cert = cert_entry['cert']
         issuer = X509Certificates.get_cert_id(cert, False)
@@ -186,48 +888,41 @@ class X509Certificates:
             return False
 
         # Try first OCSP
-        ocsp_url = X509Certificates.get_ocsp_url(cert)
+        ocsp_url = OCSP_URL or X509Certificates.get_ocsp_url(cert)
         if ocsp_url is not None:
-            return X509Certificates.get_ocsp_response(
-                cert_entry['path'], self.certs[issuer]['path'], ocsp_url)
-
-        # Download CRLs and deltas
-        if issuer not in self.crls or datetime.today() > \
-                self.crls[issuer]['crl'].to_cryptography().next_update:
-            # Download CRL
-            crl, crl_path = X509Certificates.download_crl(
-                cert, X509Certificates.get_crl_url)
+            issuer_cert = self.find_issuer(cert)
+            return issuer_cert is not None and self.get_ocsp_response(
+                cert, issuer_cert, ocsp_url)
+
+        # CRLs are downloaded the first time they are needed, and kept up to
+        # date by the refresher afterwards
+        crl = self.crls.get(issuer)
+        if crl is None:
+            try:
+                crl = self.load_issuer_crls(issuer, cert)
+            except Exception as e:
+                logger.log(logging.DEBUG, "Cannot get CRLs of %r: %s"
+                           % (issuer, e))
+                return False
 
             # If CRL is inexistant, certificate is valid
             if crl is None:
                 return True
 
-            self.crls[issuer] = {'path': crl_path, 'crl': crl, 'delta': None}
-
-        if self.crls[issuer]['delta'] is None or datetime.today() > \
-                self.crls[issuer]['delta']['crl'].to_cryptography().next_update:
-            # Download delta CRL
-            delta, delta_path = X509Certificates.download_crl(
-                cert, X509Certificates.get_delta_url)
-
-            if delta is not None:
-                self.crls[issuer]['delta'] = {'path': delta_path, 'crl': delta}
-
-        # Check if the certificate has been revoked
-        revoked_serials = []
-        for issuer in self.crls.keys():
-            crl = self.crls[issuer]
-            rev = crl['crl'].get_revoked() \
-                if crl['crl'].get_revoked() is not None else []
-            revoked_serials += [int(c.get_serial(), 16) for c in rev] \
-                if rev is not None else []
+        # Outdated CRLs the refresher couldn't update are only used as long
+        # as the policy allows it
+        if datetime.today() > \
+                self.usable_until(crl['crl'].to_cryptography().next_update):
+            logger.log(logging.DEBUG, "Outdated CRL of %r" % issuer)
+            self.count_outcome('failed_closed')
+            return False
 
-            rev = crl['delta']['crl'].get_revoked() \
-                if crl['delta'] is not None \
-                   and crl['delta']['crl'].get_revoked() is not None else []
-            revoked_serials += [int(c.get_serial(), 16) for c in rev]
+        # Check if the certificate has been revoked by its issuer
+        serial = cert.get_serial_number()
+        if serial in crl['revoked']:
+            return False
 
-        return cert.get_serial_number() not in revoked_serials
+        return crl['delta'] is None or serial not in crl['delta']['revoked']
 
     def validate_cert(self, cert):
         cert_id = X509Certificates.get_cert_id(cert)
@@ -237,83 +932,66 @@ class X509Certificates:
         c = self.get_user_cert(cert_id, cert)
 
         # Verify first the cache
-        if cert_id in self.valid_certs \
-                and self.valid_certs[cert_id]['serial'] == \
-                        cert.get_serial_number() \
-                and self.valid_certs[cert_id]['date'] \
-                        + timedelta(days=1) > datetime.today():
-            logger.log(logging.DEBUG, "[Cache] Valid certificate: %r" % cert_id)
-            return True
+        fingerprint = X509Certificates.get_fingerprint(cert)
+        valid = self.cached_validation(fingerprint)
+        if valid is not None:
+            logger.log(logging.DEBUG, "[Cache] %s certificate: %r"
+                       % ('Valid' if valid else 'Invalid', cert_id))
+            return valid
+
+        chain = self.verify_cert(cert, c)
+        if chain is None:
+            logger.log(logging.DEBUG, "Invalid certificate: %r" % cert_id)
+            self.cache_validation(fingerprint, False)
+            return False
+
+        logger.log(logging.DEBUG, "Valid certificate: %r" % cert_id)
+        self.cache_validation(fingerprint, True, chain)
+        return True
 
+    def verify_cert(self, cert, c):
+        """Verify a certificate and its chain.
+        Returns the certificates of the chain, or None if it is not valid.
+        """
         # Check if it has extension KeyUsage with digital signature
         try:
             ext = cert.to_cryptography().extensions.get_extension_for_oid(
                 oid.ExtensionOID.KEY_USAGE)
 
             if not ext.value.digital_signature:
-                logger.log(logging.DEBUG, "Invalid certificate: %r" % cert_id)
-                return False
+                return None
         except extensions.ExtensionNotFound:
-            return False
-
-        # Check if all certificates in the chain are valid
-        while True:
-            subject = X509Certificates.get_cert_id(c['cert'])
-            issuer = X509Certificates.get_cert_id(c['cert'], False)
+            return None
 
-            if issuer not in self.certs.keys():
-                logger.log(logging.DEBUG, "Invalid certificate: %r" % cert_id)
-                return False
+        # Check the certificate, and then the chain of its issuer, which is
+        # only checked again once it is no longer cached
+        issuer = self.find_issuer(c['cert'])
+        if issuer is None:
+            return None
 
-            # Self-signed -> stop chain
-            if issuer == subject:
-                break
+        if X509Certificates.is_self_signed(c['cert']):
+            chain = []
+        elif self.check_expiration_or_revoked(c):
+            chain = [c['cert']]
+        else:
+            return None
 
-            # Check validity
-            if not self.check_expiration_or_revoked(c):
-                logger.log(logging.DEBUG, "Invalid certificate: %r" % cert_id)
-                return False
+        issuer_chain = self.get_ca_chain(issuer)
+        if issuer_chain is None:
+            return None
 
-            c = self.certs[issuer]
+        chain += issuer_chain
 
         # Check if the chain is valid
         try:
-            # Create certificate store
-            store = crypto.X509Store()
-            store.set_flags(crypto.X509StoreFlags.CRL_CHECK_ALL)
-            for subject in self.certs.keys():
-                store.add_cert(self.certs[subject]['cert'])
-
-            for subject in self.crls.keys():
-                store.add_crl(self.crls[subject]['crl'])
-                if self.crls[subject]['delta'] is not None:
-                    store.add_crl(self.crls[subject]['delta']['crl'])
-
-            # Create a certificate context using the store and
+            # Create a certificate context using the CA store and
             # the certificate to be verified
-            store_ctx = crypto.X509StoreContext(store, cert)
+            store_ctx = crypto.X509StoreContext(self.get_store(), cert)
 
             # Verify the certificate, returns None
             # if it can validate the certificate
             store_ctx.verify_certificate()
+        except Exception:
+            return None
 
-            # If it gets here, it means it's valid
-            logger.log(logging.DEBUG, "Valid certificate: %r" % cert_id)
-
-            # Update cache
-            self.valid_certs[cert_id] = {
-                'serial': cert.get_serial_number(),
-                'date': datetime.today()
-            }
-
-            return True
-
-        except Exception as e:
-            logger.log(logging.DEBUG, "Invalid certificate: %r" % cert_id)
-
-            # Remove from cache
-            if cert_id in self.valid_certs:
-                del self.valid_certs[cert_id]
-
-            return False
-
+        return chain
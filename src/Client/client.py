@@ -6,6 +6,8 @@ from lib import *
 from socket import *
 from termcolor import colored
 import json
+import queue
+import threading
 import getpass
 import base64
 import os
@@ -20,6 +22,11 @@ PORT = 8080  # The server port
 BUFSIZE = 512 * 1024
 TERMINATOR = "\n\n"
 MAX_BUFSIZE = 64 * 1024
+CHUNK_SIZE = 16 * 1024
+WAIT_TIMEOUT = 30
+PIPELINE_DEPTH = 16
+BATCH_SIZE = 32
+LIST_PAGE_SIZE = 100
 
 
 class Client:
@@ -70,8 +77,64 @@ class Client:
         self.password = None
         self.secure = None
         self.cc_certificate = None
+        self.bufin = ""
+        self.responses = queue.Queue()
+
+        # Last listing of all messages, updated from its cursor
+        self.all_messages = None
+
+        # Responses and pushed events are read in the background
+        self.receiver = threading.Thread(target=self.receive_frames,
+                                         daemon=True)
+        self.receiver.start()
 
         self.login()
+        self.subscribe()
+
+    def receive_frames(self):
+        while True:
+            try:
+                data = self.ss.recv(BUFSIZE).decode('utf-8')
+            except OSError:
+                data = ""
+
+            # Connection closed
+            if not len(data):
+                self.responses.put(None)
+                return
+
+            self.bufin += data
+            while TERMINATOR in self.bufin:
+                frame, _, self.bufin = self.bufin.partition(TERMINATOR)
+                try:
+                    message = json.loads(frame)
+                except ValueError:
+                    logger.log(logging.DEBUG, "Invalid frame: %r" % frame)
+                    continue
+
+                if message.get('type') == 'event':
+                    self.handle_event(message)
+                else:
+                    self.responses.put(message)
+
+    def handle_event(self, message):
+        event = self.secure.uncapsulate_event_message(message)
+
+        if 'error' in event:
+            logger.log(logging.DEBUG, "ERROR: " + event['error'])
+            return
+
+        if event.get('event') == 'new':
+            print(colored("\nNew message %s from user %d" %
+                          (event['msg'], event['src']), 'green'))
+
+    def subscribe(self):
+        data = self.send_secure(self.secure.encapsulate_subscribe_message())
+
+        if 'error' in data:
+            print(colored("ERROR: " + data['error'], 'red'))
+        else:
+            logger.log(logging.DEBUG, "Subscribed to new message events")
 
     def send_payload(self, message, response=True):
         to_send = json.dumps(message)
@@ -80,11 +143,126 @@ class Client:
                          + '\r\n'.encode('utf-8'))
             to_send = to_send[BUFSIZE:]
         if response:
+            data = self.responses.get()
+            if data is None:
+                # Keep the connection closed mark for later requests
+                self.responses.put(None)
+                print(colored('ERROR: Invalid response from server', 'red'))
+            return data
+
+    def send_secure(self, payload):
+        data = self.send_payload(self.secure.encapsulate_secure_message(payload))
+        return self.secure.uncapsulate_secure_message(data)
+
+    def send_pipelined(self, payloads):
+        """Send requests without waiting for each response, keeping up to
+        PIPELINE_DEPTH of them in flight.
+        Returns the responses in the order of the requests.
+        """
+        rids = []
+        responses = {}
+
+        while len(responses) < len(payloads):
+            while len(rids) < len(payloads) \
+                    and len(rids) - len(responses) < PIPELINE_DEPTH:
+                message, rid = self.secure.encapsulate_sequenced_message(
+                    payloads[len(rids)])
+                self.send_payload(message, response=False)
+                rids.append(rid)
+
+            data = self.responses.get()
+            if data is None:
+                # Keep the connection closed mark for later requests
+                self.responses.put(None)
+                break
+
+            rid, response = self.secure.uncapsulate_sequenced_message(data)
+            if rid is None:
+                logger.log(logging.DEBUG, "ERROR: " + response['error'])
+                break
+
+            responses[rid] = response
+
+        return [responses.get(rid, {'error': 'No response from server'})
+                for rid in rids] \
+            + [{'error': 'Request not sent'}] * (len(payloads) - len(rids))
+
+    def send_chunked(self, payload):
+        """Upload a message and its copy in bounded chunks, so that no
+        request exceeds the server buffer.
+        """
+        data = self.send_secure({
+            'type': 'send',
+            'src': payload['src'],
+            'dst': payload['dst'],
+            'chunked': True
+        })
+
+        if 'error' in data:
+            return data
+
+        upload = data['result']
+        for part in ['msg', 'copy']:
+            for i in range(0, len(payload[part]), CHUNK_SIZE):
+                data = self.send_secure({
+                    'type': 'chunk',
+                    'upload': upload,
+                    'part': part,
+                    'data': payload[part][i:i + CHUNK_SIZE]
+                })
+
+                if 'error' in data:
+                    return data
+
+        return self.send_secure({
+            'type': 'chunk',
+            'upload': upload,
+            'commit': True
+        })
+
+    def recv_chunked(self, payload, data=None):
+        """Download a message in bounded chunks, optionally continuing
+        from the response to the first one.
+        """
+        if data is None:
+            payload['offset'] = 0
+            data = self.send_secure(payload)
+
+        if 'error' in data or not set({'result', 'offset', 'size'}).issubset(
+                set(data.keys())):
+            return data
+
+        message = data['result'][1]
+        while data['offset'] < data['size']:
+            payload['offset'] = data['offset']
+            chunk = self.send_secure(payload)
+
+            if 'error' in chunk:
+                return chunk
+
+            # Message shrunk or server can't go further
+            if chunk['offset'] <= data['offset']:
+                break
+
+            message += chunk['result'][1]
+            data['offset'] = chunk['offset']
+
+        data['result'][1] = message
+        return data
+
+    def message_versions(self, message_ids):
+        """Version tags of the resources of the users in the given message
+        ids, that is, the senders of received messages or the receivers of
+        sent ones.
+        """
+        user_ids = []
+        for message_id in message_ids:
             try:
-                data = json.loads(self.ss.recv(BUFSIZE).decode('utf-8').split(TERMINATOR)[0])
-                return data
-            except:
-                print('ERROR: Invalid response from server', 'red')
+                user_ids.append(int(message_id.lstrip('_').split('_')[0]))
+            except ValueError:
+                continue
+
+        return self.secure.resource_versions(user_ids)
 
     def get_resources(self, user_ids, resource_data=None):
         # Get receiver public key and certificate
@@ -98,7 +276,8 @@ class Client:
             if 'error' in resource_data:
                 print(colored("ERROR: " + resource_data['error'], 'red'))
                 return False
-            elif resource_data['result'][0]['secdata'] is None:
+            elif resource_data['result'][0].get('secdata') is None \
+                    and not resource_data['result'][0].get('unchanged'):
                 print(colored('User does not exist', 'red'))
                 return False
 
@@ -242,21 +421,34 @@ class Client:
 
         print(colored('\nGetting message boxes list ...\n', 'yellow'))
 
-        data = self.send_payload(self.secure.encapsulate_secure_message(payload))
-        data = self.secure.uncapsulate_secure_message(data)
+        # Users are listed in pages, following the cursor of each one
+        payload['fields'] = 'fingerprint'
+        payload['limit'] = LIST_PAGE_SIZE
+        header = True
+        while True:
+            data = self.send_secure(payload)
+
+            if 'error' in data:
+                print(colored("ERROR: " + data['error'], 'red'))
+                return
+            elif data['result'] is None:
+                print(colored("No users found with id " + str(user_id), 'red'))
+                return
+
+            if header:
+                print(colored("User UUID(s): ", 'green'))
+                header = False
 
-        if 'error' in data:
-            print(colored("ERROR: " + data['error'], 'red'))
-        elif data['result'] is None:
-            print(colored("No users found with id " + user_id, 'red'))
-        else:
-            print(colored("User UUID(s): ", 'green'))
             for user in data['result']:
                 print(colored(
                     str.format("\tID: {:d} - UUID: {:d}",
-                               user['id'], user['description']['uuid']),
+                               user['id'], user['uuid']),
                     'green'))
 
+            if data.get('next') is None:
+                return
+            payload['cursor'] = data['next']
+
     def list_all_new_messages(self):
         payload = {
             'type': 'new'
@@ -275,8 +467,46 @@ class Client:
         print(colored(str.format('\nGetting new messages for user {:d} ...\n',
                                  payload['id']), 'yellow'))
 
-        data = self.send_payload(self.secure.encapsulate_secure_message(payload))
-        data = self.secure.uncapsulate_secure_message(data)
+        payload['meta'] = True
+        data = self.send_secure(payload)
+
+        if 'error' in data:
+            print(colored("ERROR: " + data['error'], 'red'))
+        elif data['result']:
+            print(colored("New message(s): ", 'green'))
+            for message in data['result']:
+                print(colored(str.format(
+                    "\t{:s} - From: {:d} - Size: {:d} - Date: {:s}",
+                    message['msg'], message['src'], message['size'],
+                    time.ctime(message['time'] / 1000)), 'green'))
+        else:
+            print(colored("No new message(s)", 'green'))
+
+    def message_counts(self):
+        data = self.send_secure({'type': 'counts', 'id': self.user_id})
+
+        if 'error' in data:
+            print(colored("ERROR: " + data['error'], 'red'))
+            return
+
+        counts = data['result']
+        print(colored(str.format(
+            "Received messages: {:d} ({:d} unread)\n"
+            "Sent messages: {:d} ({:d} without receipts)",
+            counts['total'], counts['unread'], counts['sent'],
+            counts['pending']), 'green'))
+
+    def wait_new_messages(self):
+        payload = {
+            'type': 'wait',
+            'id': self.user_id,
+            'timeout': WAIT_TIMEOUT
+        }
+
+        print(colored(str.format('\nWaiting up to {:d} seconds for new '
+                                 'messages ...\n', WAIT_TIMEOUT), 'yellow'))
+
+        data = self.send_secure(payload)
 
         if 'error' in data:
             print(colored("ERROR: " + data['error'], 'red'))
@@ -305,8 +535,12 @@ class Client:
         print(colored(str.format('\nGetting all messages for user {:d} ...\n',
                                  payload['id']), 'yellow'))
 
-        data = self.send_payload(self.secure.encapsulate_secure_message(payload))
-        data = self.secure.uncapsulate_secure_message(data)
+        # Only ask for the changes since the last listing
+        cached = self.all_messages
+        if cached is not None and cached['id'] == payload['id']:
+            payload['cursor'] = cached['cursor']
+
+        data = self.send_secure(payload)
 
         if 'error' in data:
             print(colored("ERROR: " + data['error'], 'red'))
@@ -317,6 +551,17 @@ class Client:
                                           "ALL MESSAGE: %r" % data)
                 return
 
+            if 'cursor' in payload and not data.get('reset', False):
+                data['result'] = self.merge_all_messages(
+                    cached, data['result'])
+
+            if 'cursor' in data:
+                self.all_messages = {
+                    'id': payload['id'],
+                    'cursor': data['cursor'],
+                    'result': data['result']
+                }
+
             if data['result'][0]:
                 print(colored("All received messages: ", 'green'))
                 for message in data['result'][0]:
@@ -331,6 +576,18 @@ class Client:
             else:
                 print(colored("No sent messages", 'green'))
 
+    def merge_all_messages(self, cached, changes):
+        """Apply the changed received and sent messages to a previous
+        listing of all messages.
+        """
+        received = [message for message in cached['result'][0]
+                    if message.lstrip('_') not in
+                    [change.lstrip('_') for change in changes[0]]]
+        sent = cached['result'][1] + [message for message in changes[1]
+                                      if message not in cached['result'][1]]
+
+        return [received + changes[0], sent]
+
     def send_message(self):
         payload = {
             'type': 'send',
@@ -339,11 +596,14 @@ class Client:
 
         while True:
             try:
-                payload['dst'] = int(input(colored("Receiver User ID: ", 'blue')))
+                dsts = [int(dst) for dst in input(colored(
+                    "Receiver User ID(s), comma separated: ", 'blue')).split(',')]
                 break
             except ValueError:
                 print(colored("ERROR: Invalid User ID", 'red'))
 
+        payload['dst'] = dsts[0] if len(dsts) == 1 else dsts
+
         # Read message
         print(colored("Message (two line breaks to send it):", 'blue'))
         msg = ""
@@ -358,6 +618,10 @@ class Client:
 
         print(colored('\nSending Message ...\n', 'yellow'))
 
+        if len(dsts) > 1:
+            self.send_message_to_users(payload, msg)
+            return
+
         # Get receiver public key and certificate
         if not self.get_resources([payload['dst']]) \
                 or payload['dst'] not in self.secure.user_resources:
@@ -372,8 +636,10 @@ class Client:
         payload['copy'], nonce_none = self.secure.cipher_message_to_user(
             msg, self.user_id, payload['dst'], nonce=nonce)
 
-        data = self.send_payload(self.secure.encapsulate_secure_message(payload))
-        data = self.secure.uncapsulate_secure_message(data)
+        if len(payload['msg']) + len(payload['copy']) > CHUNK_SIZE:
+            data = self.send_chunked(payload)
+        else:
+            data = self.send_secure(payload)
 
         if 'error' in data:
             print(colored("ERROR: " + data['error'], 'red'))
@@ -382,6 +648,35 @@ class Client:
             print(colored("Message ID: " + data['result'][0], 'green'))
             print(colored("Receipt ID: " + data['result'][1], 'green'))
 
+    def send_message_to_users(self, payload, msg):
+        # Get receivers public key and certificate
+        if not self.get_resources(list(payload['dst'])) \
+                or not set(payload['dst']).issubset(
+                    set(self.secure.user_resources.keys())):
+            print(colored("ERROR: Receivers do not have valid info", 'red'))
+            return
+
+        # Cipher the message once, with a key entry for each receiver and
+        # one for the sender copy
+        recipients = {self.user_id: (self.secure.public_key,
+                                     self.secure.cipher_suite)}
+        for dst in payload['dst']:
+            recipients[dst] = (self.secure.user_resources[dst]['pub_key'],
+                               self.secure.user_resources[dst]['cipher_suite'])
+
+        payload['msg'], nonce = self.secure.cipher_message_to_users(
+            msg, self.user_id, recipients)
+
+        data = self.send_secure(payload)
+
+        if 'error' in data:
+            print(colored("ERROR: " + data['error'], 'red'))
+        else:
+            print(colored('\nMessage sent successfully!\n', 'green'))
+            for dst, result in zip(payload['dst'], data['result']):
+                print(colored("Receiver %d - Message ID: %s, Receipt ID: %s"
+                              % (dst, result[0], result[1]), 'green'))
+
     def receive_message(self):
         payload = {
             'type': 'recv'
@@ -407,9 +702,52 @@ class Client:
 
         print(colored('\nGetting Message ...\n', 'yellow'))
 
-        data = self.send_payload(self.secure.encapsulate_secure_message(payload))
-        data = self.secure.uncapsulate_secure_message(data)
+        payload['versions'] = self.message_versions([payload['msg']])
+        data = self.recv_chunked(payload)
+        self.show_received_message(payload['msg'], data)
+
+    def sync_messages(self):
+        """Download all new messages, with pipelined bulk receive requests.
+        """
+        print(colored('\nGetting new messages ...\n', 'yellow'))
+
+        data = self.send_secure({'type': 'new', 'id': self.user_id})
 
+        if 'error' in data:
+            print(colored("ERROR: " + data['error'], 'red'))
+            return
+        elif not data['result']:
+            print(colored("No new message(s)", 'green'))
+            return
+
+        message_ids = data['result']
+        payloads = [{'type': 'recv', 'id': self.user_id,
+                     'msgs': message_ids[i:i + BATCH_SIZE],
+                     'versions': self.message_versions(
+                         message_ids[i:i + BATCH_SIZE])}
+                    for i in range(0, len(message_ids), BATCH_SIZE)]
+        responses = self.send_pipelined(payloads)
+
+        for payload, response in zip(payloads, responses):
+            results = response.get('result')
+            if 'error' in response or not isinstance(results, list) \
+                    or len(results) != len(payload['msgs']):
+                print(colored("ERROR: " + response.get(
+                    'error', 'Invalid response from server'), 'red'))
+                continue
+
+            for message_id, data in zip(payload['msgs'], results):
+                print(colored("\nMessage ID: " + message_id, 'green'))
+
+                # Sender resources are sent once for the whole response
+                data['resources'] = response.get('resources', {'result': []})
+
+                # Messages larger than a chunk are completed one at a time
+                data = self.recv_chunked({'type': 'recv', 'id': self.user_id,
+                                          'msg': message_id}, data)
+                self.show_received_message(message_id, data)
+
+    def show_received_message(self, message_id, data):
         if 'error' in data:
             print(colored("ERROR: " + data['error'], 'red'))
         else:
@@ -431,7 +769,8 @@ class Client:
             # Decipher message
             deciphered_message = self.secure.decipher_message_from_user(
                 data['result'][1],
-                self.secure.user_resources[sender_id]['certificate']
+                self.secure.user_resources[sender_id]['certificate'],
+                self.user_id
             )
 
             if 'error' in deciphered_message:
@@ -445,6 +784,10 @@ class Client:
                               "on the message body", 'red'))
                 return
 
+            # Messages sent to several users are receipted by each one
+            if isinstance(deciphered_message['dst'], list):
+                deciphered_message['dst'] = self.user_id
+
             message = base64.b64decode(
                 deciphered_message['msg'].encode()).decode('utf-8')
 
@@ -454,7 +797,7 @@ class Client:
 
             # Send receipt
             self.receipt_message(
-                payload['msg'],
+                message_id,
                 deciphered_message['src'],
                 deciphered_message['dst'],
                 message,
@@ -515,16 +858,41 @@ class Client:
 
         while True:
             try:
-                message['msg'] = str(input(colored("Message ID: ", 'blue')))
-                break
+                message_ids = [message_id.strip() for message_id in str(
+                    input(colored("Message ID(s), comma separated: ",
+                                  'blue'))).split(',') if message_id.strip()]
+                if len(message_ids):
+                    break
             except ValueError:
-                print(colored("ERROR: Invalid message ID", 'red'))
+                pass
+            print(colored("ERROR: Invalid message ID", 'red'))
 
         print(colored('\nGetting status ...\n', 'yellow'))
 
-        data = self.send_payload(self.secure.encapsulate_secure_message(message))
-        data = self.secure.uncapsulate_secure_message(data)
+        message['versions'] = self.message_versions(message_ids)
+
+        if len(message_ids) == 1:
+            message['msg'] = message_ids[0]
+            self.show_message_status(message['msg'],
+                                     self.send_secure(message))
+            return
+
+        # Status of several messages in a single request
+        message['msgs'] = message_ids
+        data = self.send_secure(message)
 
+        if 'error' in data:
+            print(colored("ERROR: " + data['error'], 'red'))
+            return
+
+        for message_id in message_ids:
+            print(colored("\nMessage ID: " + message_id, 'green'))
+            status = data['result'].get(message_id, {'error': 'No status'})
+            self.show_message_status(message_id, status if 'error' in status
+                                     else {'result': status,
+                                           'resources': data['resources']})
+
+    def show_message_status(self, message_id, data):
         if 'error' in data:
             print(colored("ERROR: " + data['error'], 'red'))
         else:
@@ -536,8 +904,8 @@ class Client:
                 return
 
             # Decipher original sent message from receipt box
-            deciphered_message = \
-                self.secure.decipher_message_from_user(data['result']['msg'])
+            deciphered_message = self.secure.decipher_message_from_user(
+                data['result']['msg'], user_id=self.user_id)
 
             if 'error' in deciphered_message:
                 logger.log(logging.DEBUG, "Error deciphering message; "
@@ -546,6 +914,11 @@ class Client:
                               'red'))
                 return
 
+            # Copies of messages sent to several users are shared, the
+            # receiver is the one in the copy id
+            if isinstance(deciphered_message['dst'], list):
+                deciphered_message['dst'] = int(message_id.split('_')[0])
+
             # Get receiver public key and certificate
             if not self.get_resources([deciphered_message['dst']], data['resources']) \
                     or deciphered_message['dst'] not in self.secure.user_resources:
@@ -628,6 +1001,9 @@ def main():
         print(colored("4 - [SEND] Send a new message", 'blue'))
         print(colored("5 - [RECV] Receive a message from a user's message box", 'blue'))
         print(colored("6 - [STATUS] Check the status of a previously sent message", 'blue'))
+        print(colored("7 - [WAIT] Wait for new messages in your message box", 'blue'))
+        print(colored("8 - [SYNC] Receive all new messages in your message box", 'blue'))
+        print(colored("9 - [COUNTS] Count the messages in your message box", 'blue'))
         print(colored("0 - [EXIT] Exit client", 'blue'))
 
         try:
@@ -648,6 +1024,12 @@ def main():
                 client.receive_message()
             elif op == 6:
                 client.message_status()
+            elif op == 7:
+                client.wait_new_messages()
+            elif op == 8:
+                client.sync_messages()
+            elif op == 9:
+                client.message_counts()
             else:
                 print(colored("Invalid option!", 'red'))
         except ValueError:
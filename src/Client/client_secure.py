@@ -31,10 +31,22 @@ class ClientSecure:
         self.public_key = public_key
         self.prev_mac = None
 
+        # Sequenced requests, which may be pipelined
+        self.session_nonce = None
+        self.server_key = None
+        self.request_seq = 0
+        self.response_seq = 0
+        self.pending = {}
+
         self.cc_pin = pin
 
         self.user_resources = {}
 
+        # Event channel, independent from the request/response chain
+        self.event_priv_value = None
+        self.event_salt = None
+        self.event_prev_mac = None
+
     def cc_sign(self, payload):
         return base64.b64encode(cc.sign(payload, self.cc_pin)).decode()
 
@@ -43,6 +55,7 @@ class ClientSecure:
         salt = os.urandom(16)
         self.salt_list += [salt]
         self.nonce = os.urandom(16)
+        self.session_nonce = self.nonce
 
         payload = base64.b64encode(json.dumps({
             'uuid': self.uuid,
@@ -200,6 +213,7 @@ class ClientSecure:
 
         self.nonce = None
         self.prev_mac = message['mac'].encode()
+        self.server_key = (self.peer_pub_value, self.peer_salt)
 
         aes_cipher, aes_iv = generate_aes_cipher(
             aes_key,
@@ -220,11 +234,195 @@ class ClientSecure:
 
         return return_payload
 
+    def encapsulate_sequenced_message(self, payload):
+        """Cipher a request that can be sent without waiting for the
+        responses to the previous ones. Returns the message and its id.
+        """
+        # Fresh values for each request, kept until its response arrives
+        priv_value, pub_value = generate_ecdh_keypair()
+        salt = os.urandom(16)
+        peer_pub_value, peer_salt = self.server_key
+
+        self.request_seq += 1
+        rid = self.request_seq
+
+        aes_key = derive_key_from_ecdh(
+            priv_value,
+            peer_pub_value,
+            salt,
+            peer_salt,
+            self.cipher_suite['aes']['key_size'],
+            self.cipher_suite['sha']['size'],
+            1,
+        )
+
+        aes_cipher, aes_iv = generate_aes_cipher(
+            aes_key, self.cipher_suite['aes']['mode'])
+
+        encryptor = aes_cipher.encryptor()
+        ciphered_payload = encryptor.update(json.dumps(payload).encode())\
+                           + encryptor.finalize()
+
+        # Request id and sequence number are covered by the MAC
+        message_payload = base64.b64encode(json.dumps({
+            'message': base64.b64encode(ciphered_payload).decode(),
+            'secdata': {
+                'dhpubvalue': serialize_key(pub_value),
+                'salt': base64.b64encode(salt).decode(),
+                'iv': base64.b64encode(aes_iv).decode(),
+                'index': 1,
+                'peer_salt': base64.b64encode(peer_salt).decode(),
+                'rid': rid,
+                'seq': self.request_seq
+            }
+        }).encode())
+
+        # Bound to the session by the init nonce instead of a MAC chain
+        mac = base64.b64encode(generate_mac(
+            aes_key,
+            message_payload + self.session_nonce,
+            self.cipher_suite['sha']['size']
+        ))
+
+        self.pending[rid] = {'priv_value': priv_value, 'salt': salt}
+
+        message = {
+            'type': 'secure',
+            'payload': message_payload.decode(),
+            'mac': mac.decode(),
+            'cipher_spec': self.cipher_spec
+        }
+
+        logger.log(logging.DEBUG, "SEQUENCED MESSAGE SENT: %r" % message)
+
+        return message, rid
+
+    def uncapsulate_sequenced_message(self, message):
+        """Returns the id of the request answered and the response.
+        """
+        logger.log(logging.DEBUG, "SEQUENCED MESSAGE RECEIVED: %r" % message)
+
+        # Check all payload fields
+        if not set({'payload', 'cipher_spec', 'mac'}).issubset(
+                set(message.keys())):
+            logger.log(logging.DEBUG, "ERROR: INCOMPLETE FIELDS IN SECURE "
+                                      "MESSAGE: %r" % message)
+            return None, {'error': 'Invalid secure message format'}
+
+        payload = json.loads(
+            base64.b64decode(message['payload'].encode()).decode())
+        secdata = payload['secdata']
+
+        if secdata.get('rid') not in self.pending:
+            return None, {'error': "Message doesn't match a pending request"}
+
+        rid = secdata['rid']
+
+        # Responses are sent in order, anything else is a replay or a drop
+        if secdata['seq'] != self.response_seq + 1:
+            return rid, {'error': "Invalid sequence number; dropping message"}
+
+        peer_pub_value = deserialize_key(secdata['dhpubvalue'])
+        peer_salt = base64.b64decode(secdata['salt'].encode())
+
+        aes_key = derive_key_from_ecdh(
+            self.pending[rid]['priv_value'],
+            peer_pub_value,
+            peer_salt,
+            self.pending[rid]['salt'],
+            self.cipher_suite['aes']['key_size'],
+            self.cipher_suite['sha']['size'],
+            1,
+        )
+
+        # Verify MAC to make sure of message integrity
+        if not verify_mac(aes_key,
+                          message['payload'].encode() + self.session_nonce,
+                          base64.b64decode(message['mac'].encode()),
+                          self.cipher_suite['sha']['size']):
+            return rid, {'error': "Invalid MAC; dropping message"}
+
+        self.response_seq = secdata['seq']
+        self.server_key = (peer_pub_value, peer_salt)
+        del self.pending[rid]
+
+        aes_cipher, aes_iv = generate_aes_cipher(
+            aes_key,
+            self.cipher_suite['aes']['mode'],
+            base64.b64decode(secdata['iv'].encode())
+        )
+
+        decryptor = aes_cipher.decryptor()
+        return_payload = decryptor.update(base64.b64decode(
+            payload['message'].encode())) + decryptor.finalize()
+
+        return rid, json.loads(json.loads(return_payload.decode()))
+
+    def encapsulate_subscribe_message(self):
+        self.event_priv_value, event_pub_value = generate_ecdh_keypair()
+        self.event_salt = os.urandom(16)
+        self.event_prev_mac = os.urandom(16)
+
+        payload = {
+            'type': 'subscribe',
+            'secdata': {
+                'dhpubvalue': serialize_key(event_pub_value),
+                'salt': base64.b64encode(self.event_salt).decode(),
+                'nonce': base64.b64encode(self.event_prev_mac).decode()
+            }
+        }
+
+        logger.log(logging.DEBUG, "SUBSCRIBE MESSAGE SENT: %r" % payload)
+
+        return payload
+
+    def uncapsulate_event_message(self, message):
+        logger.log(logging.DEBUG, "EVENT MESSAGE RECEIVED: %r" % message)
+
+        # Check all payload fields
+        if not set({'payload', 'cipher_spec', 'mac'}).issubset(
+                set(message.keys())) or self.event_priv_value is None:
+            logger.log(logging.DEBUG, "ERROR: INCOMPLETE FIELDS IN EVENT "
+                                      "MESSAGE: %r" % message)
+            return {'error': 'Invalid event message format'}
+
+        payload = json.loads(
+            base64.b64decode(message['payload'].encode()).decode())
+
+        aes_key = derive_key_from_ecdh(
+            self.event_priv_value,
+            deserialize_key(payload['secdata']['dhpubvalue']),
+            base64.b64decode(payload['secdata']['salt'].encode()),
+            self.event_salt,
+            self.cipher_suite['aes']['key_size'],
+            self.cipher_suite['sha']['size'],
+            1,
+        )
+
+        # Verify MAC to make sure of message integrity and ordering
+        if not verify_mac(aes_key,
+                          message['payload'].encode() + self.event_prev_mac,
+                          base64.b64decode(message['mac'].encode()),
+                          self.cipher_suite['sha']['size']):
+            return {'error': "Invalid MAC; dropping event"}
+
+        self.event_prev_mac = message['mac'].encode()
+
+        aes_cipher, aes_iv = generate_aes_cipher(
+            aes_key,
+            self.cipher_suite['aes']['mode'],
+            base64.b64decode(payload['secdata']['iv'].encode())
+        )
+
+        decryptor = aes_cipher.decryptor()
+        return_payload = decryptor.update(base64.b64decode(
+            payload['message'].encode())) + decryptor.finalize()
+
+        return json.loads(json.loads(return_payload.decode()))
+
     def encapsulate_resource_message(self, ids):
         # Check if already exists user public infos
-        for user in ids:
-            if user in self.user_resources:
-                ids.remove(user)
+        ids = [user for user in ids if user not in self.user_resources]
 
         if not len(ids):
             return None
@@ -251,6 +449,10 @@ class ClientSecure:
 
         # Save user public values, certificate and cipher_spec
         for user in resource_payload['result']:
+            # Already known and not changed since
+            if user.get('unchanged') and user.get('id') in self.user_resources:
+                continue
+
             if not set({'secdata', 'signature'}).issubset(set(user.keys())):
                 logger.log(logging.DEBUG, "ERROR: INVALID FIELDS IN USER "
                                           "RESOURCE MESSAGE: %r" % user)
@@ -285,9 +487,18 @@ class ClientSecure:
                 'pub_key': deserialize_key(secdata['rsapubkey']),
                 'cc_pub_key': user_cert.get_pubkey().to_cryptography_key(),
                 'certificate': user_cert,
-                'cipher_suite': cipher_suite
+                'cipher_suite': cipher_suite,
+                'version': user.get('version')
             }
 
+    def resource_versions(self, ids):
+        """Version tags of the known resources of the given users, sent so
+        that the server omits the unchanged ones.
+        """
+        return {str(user): self.user_resources[user]['version']
+                for user in set(ids) if user in self.user_resources
+                and self.user_resources[user].get('version') is not None}
+
     def cipher_message_to_user(self, message, src_id, dst_id,
                                peer_rsa_pubkey=None, nonce=None,
                                cipher_suite=None):
@@ -339,7 +550,59 @@ class ClientSecure:
 
         return base64.b64encode(json.dumps(payload).encode()).decode(), nonce
 
-    def decipher_message_from_user(self, payload, peer_certificate=None):
+    def cipher_message_to_users(self, message, src_id, recipients,
+                                nonce=None):
+        """Cipher a message once for several users. recipients maps each
+        user id (including the sender, for the copy) to its RSA public key
+        and cipher suite; only the AES key is ciphered for each one.
+        """
+        # Cipher payload
+        aes_key = os.urandom(self.cipher_suite['aes']['key_size'])
+        aes_cipher, aes_iv = generate_aes_cipher(
+            aes_key, self.cipher_suite['aes']['mode'])
+
+        encryptor = aes_cipher.encryptor()
+        ciphered_message = encryptor.update(json.dumps(message).encode()) + \
+                           encryptor.finalize()
+
+        # Generate nonce to verify message readings
+        if nonce is None:
+            nonce = os.urandom(16)
+
+        # Cipher nonce and AES key and IV to each recipient
+        keys = {}
+        for user_id in recipients:
+            peer_rsa_pubkey, cipher_suite = recipients[user_id]
+            keys[str(user_id)] = {
+                'nonce_key_iv': base64.b64encode(rsa_cipher(
+                    peer_rsa_pubkey,
+                    aes_iv + aes_key + nonce,
+                    cipher_suite['sha']['size'],
+                    cipher_suite['rsa']['cipher']['padding']
+                )).decode(),
+                'cipher_spec': cipher_suite
+            }
+
+        message_payload = base64.b64encode(json.dumps({
+            'src': src_id,
+            'dst': [user_id for user_id in recipients if user_id != src_id],
+            'message': base64.b64encode(ciphered_message).decode(),
+            'keys': keys
+        }).encode())
+
+        # Sign payload
+        signature = base64.b64encode(cc.sign(message_payload, self.cc_pin))
+
+        payload = {
+            'payload': message_payload.decode(),
+            'signature': signature.decode(),
+            'cipher_spec': self.cipher_suite
+        }
+
+        return base64.b64encode(json.dumps(payload).encode()).decode(), nonce
+
+    def decipher_message_from_user(self, payload, peer_certificate=None,
+                                   user_id=None):
         if peer_certificate is None:
             peer_certificate = self.cc_cert
 
@@ -380,12 +643,23 @@ class ClientSecure:
         src = message_payload['src']
         dst = message_payload['dst']
 
+        # Messages to several users have a key entry for each one
+        key_suite = cipher_suite
+        nonce_key_iv = message_payload.get('nonce_key_iv')
+        if 'keys' in message_payload:
+            if str(user_id) not in message_payload['keys']:
+                return {'error': 'Message not ciphered to this user'}
+
+            key_suite = message_payload['keys'][str(user_id)]['cipher_spec']
+            nonce_key_iv = \
+                message_payload['keys'][str(user_id)]['nonce_key_iv']
+
         # Decipher nonce and AES key and IV
         nonce_aes_iv_key = rsa_decipher(
             self.private_key,
-            base64.b64decode(message_payload['nonce_key_iv'].encode()),
-            cipher_suite['sha']['size'],
-            cipher_suite['rsa']['cipher']['padding']
+            base64.b64decode(nonce_key_iv.encode()),
+            key_suite['sha']['size'],
+            key_suite['rsa']['cipher']['padding']
         )
 
         # If the user can't decrypt, return error message
@@ -4,4 +4,28 @@ DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 CERTS_DIR = DIR_PATH + '/certs/'
 USER_CERTS_DIR = DIR_PATH + '/certs/users/'
 CRLS_DIR = DIR_PATH + '/crl/'
+CRLS_INDEX = CRLS_DIR + 'index.json'
+CRL_REFRESH_INTERVAL = 60
+CRL_PREFETCH = 60 * 60
+CRL_PREFETCH_JITTER = 10 * 60
+OCSP_DEFAULT_TTL = 60 * 60
+# Clock difference tolerated with OCSP responders
+OCSP_CLOCK_SKEW = 5 * 60
+# Seconds to wait for CRL and OCSP endpoints, by host
+REVOCATION_TIMEOUT = 10
+REVOCATION_TIMEOUTS = {}
+# Endpoints failing this many times in a row are skipped for a while
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 5 * 60
+# 'stale' uses outdated revocation data for up to STALE_GRACE seconds
+# when it can't be refreshed, 'fail-closed' rejects certificates instead
+REVOCATION_POLICY = 'stale'
+STALE_GRACE = 24 * 60 * 60
+# Responder used instead of the one in the certificates, if set
+OCSP_URL = os.environ.get('OCSP_URL')
+# Results of validating certificates, shared by every process
+VALIDATION_CACHE = DIR_PATH + '/validation.json'
+VALIDATION_TTL = 24 * 60 * 60
+VALIDATION_NEGATIVE_TTL = 5 * 60
+MAX_CHAIN_DEPTH = 8
 KEYS_DIR = DIR_PATH + '/keys/'
\ No newline at end of file
@@ -6,6 +6,59 @@ CERTS_DIR = DIR_PATH + '/certs/'
 USER_CERTS_DIR = DIR_PATH + '/certs/users/'
 CRLS_DIR = DIR_PATH + '/crls/'
 XCA_DIR = DIR_PATH + '/xca-server/'
+CRLS_INDEX = CRLS_DIR + 'index.json'
+CRL_REFRESH_INTERVAL = 60
+CRL_PREFETCH = 60 * 60
+CRL_PREFETCH_JITTER = 10 * 60
+OCSP_DEFAULT_TTL = 60 * 60
+# Clock difference tolerated with OCSP responders
+OCSP_CLOCK_SKEW = 5 * 60
+# Seconds to wait for CRL and OCSP endpoints, by host
+REVOCATION_TIMEOUT = 10
+REVOCATION_TIMEOUTS = {}
+# Endpoints failing this many times in a row are skipped for a while
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 5 * 60
+# 'stale' uses outdated revocation data for up to STALE_GRACE seconds
+# when it can't be refreshed, 'fail-closed' rejects certificates instead
+REVOCATION_POLICY = 'stale'
+STALE_GRACE = 24 * 60 * 60
+# Responder used instead of the one in the certificates, if set
+OCSP_URL = os.environ.get('OCSP_URL')
+# Results of validating certificates, shared by every process
+VALIDATION_CACHE = DIR_PATH + '/validation.json'
+VALIDATION_TTL = 24 * 60 * 60
+VALIDATION_NEGATIVE_TTL = 5 * 60
+MAX_CHAIN_DEPTH = 8
+# Threads validating saved user certificates after startup (0 disables it),
+# and how often to log their progress
+CERT_WARMUP_WORKERS = 8
+CERT_WARMUP_PROGRESS = 100
 MBOXES_PATH = DIR_PATH + '/mboxes'
 RECEIPTS_PATH = DIR_PATH + '/receipts'
 DESC_FILENAME = 'description'
+INDEX_FILENAME = 'index'
+ARCHIVES_PATH = DIR_PATH + '/archives'
+RETENTION_PATH = DIR_PATH + '/retention.json'
+RETENTION_DEFAULT = 30 * 24 * 60 * 60
+PACK_MERGE_THRESHOLD = 8
+COMPACT_INTERVAL = 60
+# Work done by each compaction step, so it doesn't stall requests
+COMPACT_MAX_ENTRIES = 200
+COMPACT_MAX_BYTES = 4 * 1024 * 1024
+COMPACT_MAX_TIME = 0.2
+UPLOADS_PATH = DIR_PATH + '/uploads'
+CHUNK_SIZE = 16 * 1024
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# Uploads a client may have pending at once, and their total size
+MAX_UPLOADS = 4
+MAX_UPLOADS_SIZE = 2 * MAX_MESSAGE_SIZE
+BODIES_PATH = DIR_PATH + '/bodies'
+WAIT_TIMEOUT = 30
+WAIT_TIMEOUT_MAX = 300
+MAX_BATCH_SIZE = 500
+LIST_PAGE_SIZE = 100
+LIST_PAGE_SIZE_MAX = 1000
+CHANGE_LOG_SIZE = 1024
+# Changes appended to a mailbox journal before it is folded into the index
+INDEX_JOURNAL_SIZE = 256
@@ -13,6 +13,7 @@ from cipher_utils import *
 from socket import *
 from select import *
 import json
+import signal
 import sys
 import time
 import logging
@@ -40,6 +41,17 @@ class Server:
         # clients to manage (indexed by socket and by name):
         Server.server_actions = ServerActions()
         self.clients = {}  # clients (key is socket)
+        self.last_compact = time.time()
+
+        # SIGHUP reloads the certificates and keys, waking up the loop
+        # through the wakeup socket
+        self.reload_requested = False
+        self.wakeup_r, self.wakeup_w = socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        if hasattr(signal, 'SIGHUP'):
+            signal.set_wakeup_fd(self.wakeup_w.fileno())
+            signal.signal(signal.SIGHUP, self.requestReload)
 
     def stop(self):
         """ Stops the server closing all sockets
@@ -50,6 +62,13 @@ class Server:
         except:
             logging.exception("Server.stop")
 
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
         for csock in self.clients:
             try:
                 self.clients[csock].close()  # Client.close!
@@ -85,6 +104,7 @@ class Server:
 
         client = self.clients[csock]
         del self.clients[client.socket]
+        Server.server_actions.removeClient(client)
         client.close()
         logger.log(logging.DEBUG, "Client deleted: %s" % client)
 
@@ -97,6 +117,47 @@ class Server:
         except:
             logging.exception("Could not accept client")
 
+    def requestReload(self, signum, frame):
+        self.reload_requested = True
+
+    def wakeup(self):
+        """Handle the signals received while waiting.
+        """
+        try:
+            while self.wakeup_r.recv(BUFSIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+        if self.reload_requested:
+            self.reload_requested = False
+            self.reloadCertificates()
+
+    def reloadCertificates(self):
+        """Reload the CA certificates and the server key and certificate.
+        Connected clients keep the ones they started with.
+        """
+        logger.log(logging.INFO, "Reloading certificates")
+        try:
+            changes = Server.server_actions.certificates.reload()
+        except:
+            logging.exception("Cannot reload certificates")
+            return
+
+        messages = {
+            'added': "CA certificates added",
+            'removed': "CA certificates removed",
+            'changed': "CA certificates changed",
+            'server': "Server certificates changed"
+        }
+        for kind in messages:
+            if changes[kind]:
+                logger.log(logging.INFO, "%s: %s" %
+                    (messages[kind], ", ".join(changes[kind])))
+
+        if not any(changes.values()):
+            logger.log(logging.INFO, "No certificates changed")
+
     def flushin(self, s):
         """Read a chunk of data from this client.
         Enqueue any complete requests.
@@ -150,21 +211,33 @@ class Server:
 
     def loop(self):
         while True:
+            # Wake up in time for pending waits and maintenance
+            timeout = Server.server_actions.expireWaiters()
+            timeout = COMPACT_INTERVAL if timeout is None \
+                else min(timeout, COMPACT_INTERVAL)
+
             # sockets to select for reading: (the server socket + every open
             # client connection)
-            rlist = [self.ss] + list(self.clients.keys())
+            rlist = [self.ss, self.wakeup_r] + list(self.clients.keys())
 
             # sockets to select for writing: (those that have something in
             # bufout)
             wlist = [sock for sock in self.clients if len(
                 self.clients[sock].bufout) > 0]
 
-            (rl, wl, xl) = select(rlist, wlist, rlist)
+            (rl, wl, xl) = select(rlist, wlist, rlist, timeout)
+
+            # Move old messages to the archive between requests
+            if time.time() - self.last_compact >= COMPACT_INTERVAL:
+                Server.server_actions.registry.compactStep()
+                self.last_compact = time.time()
 
             # Deal with incoming data:
             for s in rl:
                 if s is self.ss:
                     self.accept()
+                elif s is self.wakeup_r:
+                    self.wakeup()
                 elif s in self.clients:
                     self.flushin(s)
                 else:
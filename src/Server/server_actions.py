@@ -5,6 +5,7 @@ from server_client import *
 from certificates import *
 import json
 import re
+import time
 
 
 class ServerActions:
@@ -15,19 +16,57 @@ class ServerActions:
             'all': self.processAll,
             'list': self.processList,
             'new': self.processNew,
+            'wait': self.processWait,
             'send': self.processSend,
             'recv': self.processRecv,
+            'chunk': self.processChunk,
             'create': self.processCreate,
             'receipt': self.processReceipt,
             'status': self.processStatus,
             'resource': self.processResource,
             'init': self.processInit,
+            'subscribe': self.processSubscribe,
+            'batch': self.processBatch,
+            'counts': self.processCounts,
             'error': self.processError
         }
 
+        # Requests that can't be part of a batch
+        self.unbatchedTypes = {'batch', 'init', 'subscribe', 'wait'}
+
         self.registry = ServerRegistry()
         self.certificates = X509Certificates(self.registry.users)
 
+        # Connected clients subscribed to events, by user id
+        self.subscribers = {}
+        self.registry.addListener(self.notifySubscribers)
+
+        # Clients with a pending "wait" request, by user id
+        self.waiters = {}
+        self.registry.addListener(self.wakeWaiters)
+
+    def removeClient(self, client):
+        """Release the resources held by a disconnected client.
+        """
+        for upload in client.uploads:
+            self.registry.abortUpload(upload)
+
+        client.uploads.clear()
+
+        for user_id in list(self.subscribers.keys()):
+            self.subscribers[user_id].discard(client)
+            if not self.subscribers[user_id]:
+                del self.subscribers[user_id]
+
+        if client.wait is not None:
+            self.dropWait(client)
+
+    def notifySubscribers(self, user_id, event):
+        for client in self.subscribers.get(user_id, []):
+            logger.log(logging.DEBUG, "Pushing event to %s: %r" %
+                (client, event))
+            client.sendEvent(dict(event, type='event'))
+
     def handleRequest(self, s, request, client):
         """Handle a request from a client socket.
         """
@@ -49,6 +88,13 @@ class ServerActions:
                 logger.log(logging.ERROR, "Message has no TYPE field")
                 return
 
+            # Unless both are sequenced, responses must follow the order of
+            # the requests, so a pending wait is answered first
+            if client.wait is not None and (
+                    client.wait['request']['rid'] is None
+                    or client.secure.current_request['rid'] is None):
+                self.completeWait(client)
+
             if req['type'] in self.messageTypes:
                 self.messageTypes[req['type']](req, client)
             else:
@@ -102,9 +148,34 @@ class ServerActions:
 
         logger.log(logging.DEBUG, "List %s" % userStr)
 
-        userList = self.registry.listUsers(user)
+        try:
+            cursor = int(data.get('cursor', 0))
+            limit = min(int(data.get('limit', LIST_PAGE_SIZE)),
+                        LIST_PAGE_SIZE_MAX)
+        except (TypeError, ValueError):
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        fields = data.get('fields', 'full')
+        if limit <= 0 or fields not in ['ids', 'fingerprint', 'full']:
+            client.sendResult({"error": "wrong parameters"})
+            return
+
+        # One extra user tells whether there is a next page
+        userList = self.registry.listUsers(user, cursor, limit + 1)
 
-        client.sendResult({"result": userList})
+        nextCursor = None
+        if userList is not None and len(userList) > limit:
+            userList = userList[:limit]
+            nextCursor = userList[-1].id
+
+        if userList is not None and fields == 'ids':
+            userList = [{'id': u.id} for u in userList]
+        elif userList is not None and fields == 'fingerprint':
+            userList = [{'id': u.id, 'uuid': u.description['uuid'],
+                         'version': u.version} for u in userList]
+
+        client.sendResult({"result": userList, "next": nextCursor})
 
     def processNew(self, data, client):
         logger.log(logging.DEBUG, "%s" % json.dumps(data))
@@ -134,7 +205,107 @@ class ServerActions:
             client.sendResult({"error": "wrong parameters"})
             return
 
-        client.sendResult({"result": self.registry.userNewMessages(user)})
+        try:
+            filters = self.listingFilters(data)
+        except (TypeError, ValueError):
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        msgs = self.registry.userNewMessages(user)
+        client.sendResult({"result": self.messageListing(user, msgs, filters)})
+
+    def processWait(self, data, client):
+        logger.log(logging.DEBUG, "%s" % json.dumps(data))
+
+        user = -1
+        if 'id' in list(data.keys()):
+            user = int(data['id'])
+
+        if user < 0:
+            logger.log(logging.ERROR,
+                "No valid \"id\" field in \"wait\" message: " + json.dumps(data))
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        if not self.registry.userExists(user):
+            logger.log(logging.ERROR,
+                "Unknown source id for \"wait\" message: " + json.dumps(data))
+            client.sendResult({"error": "wrong parameters"})
+            return
+
+        if self.registry.getUser(client.secure.uuid).id != user:
+            logger.log(
+                logging.ERROR,
+                "Source id different from client id for \"wait\" message: "
+                + json.dumps(data)
+            )
+            client.sendResult({"error": "wrong parameters"})
+            return
+
+        try:
+            timeout = min(float(data.get('timeout', WAIT_TIMEOUT)),
+                          WAIT_TIMEOUT_MAX)
+        except (TypeError, ValueError):
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        # NaN would never expire
+        if not timeout >= 0:
+            client.sendResult({"error": "wrong parameters"})
+            return
+
+        new = self.registry.userNewMessages(user)
+        if new:
+            client.sendResult({"result": new})
+            return
+
+        # Only one wait per client may be pending
+        if client.wait is not None:
+            self.completeWait(client)
+
+        # Hold the response until a message arrives or the timeout expires
+        client.wait = {
+            'id': user,
+            'deadline': time.time() + timeout,
+            'request': client.secure.current_request
+        }
+        self.waiters.setdefault(user, set()).add(client)
+
+    def dropWait(self, client):
+        wait = client.wait
+        client.wait = None
+
+        self.waiters[wait['id']].discard(client)
+        if not self.waiters[wait['id']]:
+            del self.waiters[wait['id']]
+
+        return wait
+
+    def completeWait(self, client):
+        wait = self.dropWait(client)
+        client.sendResult({"result": self.registry.userNewMessages(wait['id'])},
+                          wait['request'])
+
+    def wakeWaiters(self, user_id, event):
+        for client in list(self.waiters.get(user_id, [])):
+            self.completeWait(client)
+
+    def expireWaiters(self):
+        """Answer the waits whose timeout has expired.
+        Returns the number of seconds until the next one expires, if any.
+        """
+        now = time.time()
+        next_deadline = None
+
+        for user_id in list(self.waiters.keys()):
+            for client in list(self.waiters.get(user_id, [])):
+                if client.wait['deadline'] <= now:
+                    self.completeWait(client)
+                elif next_deadline is None \
+                        or client.wait['deadline'] < next_deadline:
+                    next_deadline = client.wait['deadline']
+
+        return None if next_deadline is None else next_deadline - now
 
     def processAll(self, data, client):
         logger.log(logging.DEBUG, "%s" % json.dumps(data))
@@ -164,25 +335,107 @@ class ServerActions:
             client.sendResult({"error": "wrong parameters"})
             return
 
+        try:
+            filters = self.listingFilters(data)
+        except (TypeError, ValueError):
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        # Only the changes after the client cursor, unless it is too old
+        cursor = self.registry.mailbox(user).seq
+        if 'cursor' in data:
+            try:
+                result = self.registry.userChanges(user, int(data['cursor']))
+            except (TypeError, ValueError):
+                client.sendResult({"error": "wrong message format"})
+                return
+
+            if result is not None:
+                result[0] = self.messageListing(user, result[0], filters)
+                client.sendResult({"result": result, "cursor": cursor})
+                return
+
+        msgs = self.registry.userAllMessages(user)
         client.sendResult({
             "result": [
-                self.registry.userAllMessages(user),
+                self.messageListing(user, msgs, filters),
                 self.registry.userSentMessages(user)
-            ]
+            ],
+            "cursor": cursor,
+            "reset": 'cursor' in data
         })
 
+    def listingFilters(self, data):
+        """Sender (src) and arrival time (since and until, in milliseconds)
+        filters of a listing, and whether it gives metadata (meta).
+        Raises TypeError or ValueError if they are malformed.
+        """
+        filters = {key: int(data[key]) if key in data else None
+                   for key in ['src', 'since', 'until']}
+        filters['meta'] = bool(data.get('meta', False))
+        return filters
+
+    def messageListing(self, user, msgs, filters):
+        """Filter received messages as given by listingFilters, and give
+        their metadata if asked.
+        """
+        src = filters['src']
+        since = filters['since']
+        until = filters['until']
+        if src is None and since is None and until is None \
+                and not filters['meta']:
+            return msgs
+
+        records = [r for r in self.registry.messageRecords(user, msgs)
+                   if (src is None or r['src'] == src)
+                   and (since is None or r['time'] >= since)
+                   and (until is None or r['time'] < until)]
+
+        if filters['meta']:
+            return records
+
+        return [r['msg'] for r in records]
+
+    def processCounts(self, data, client):
+        logger.log(logging.DEBUG, "%s" % json.dumps(data))
+
+        user = int(data['id']) if 'id' in data else -1
+
+        if user < 0 or not self.registry.userExists(user) \
+                or self.registry.getUser(client.secure.uuid).id != user:
+            logger.log(logging.ERROR,
+                "Invalid source id for \"counts\" message: " +
+                json.dumps(data))
+            client.sendResult({"error": "wrong parameters"})
+            return
+
+        client.sendResult({"result": self.registry.messageCounts(user)})
+
     def processSend(self, data, client):
         logger.log(logging.DEBUG, "%s" % json.dumps(data))
 
-        if not set(data.keys()).issuperset(set({'src', 'dst', 'msg', 'copy'})):
+        # A list of destinations shares a single message body, which also
+        # works as the sender copy
+        chunked = data.get('chunked', False)
+        multiple = isinstance(data.get('dst'), list)
+
+        if chunked:
+            fields = {'src', 'dst'}
+        elif multiple:
+            fields = {'src', 'dst', 'msg'}
+        else:
+            fields = {'src', 'dst', 'msg', 'copy'}
+
+        if not set(data.keys()).issuperset(fields) \
+                or (multiple and (chunked or not len(data['dst']))):
             logger.log(logging.ERROR,
                 "Badly formatted \"send\" message: " + json.dumps(data))
             client.sendResult({"error": "wrong message format"})
+            return
 
         srcId = int(data['src'])
-        dstId = int(data['dst'])
-        msg = str(data['msg'])
-        copy = str(data['copy'])
+        dstIds = list(dict.fromkeys(int(d) for d in data['dst'])) \
+            if multiple else [int(data['dst'])]
 
         if not self.registry.userExists(srcId):
             logger.log(logging.ERROR,
@@ -199,29 +452,98 @@ class ServerActions:
             client.sendResult({"error": "wrong parameters"})
             return
 
-        if not self.registry.userExists(dstId):
-            logger.log(logging.ERROR,
-                "Unknown destination id for \"send\" message: "
-                       + json.dumps(data))
-            client.sendResult({"error": "wrong parameters"})
+        for dstId in dstIds:
+            if not self.registry.userExists(dstId):
+                logger.log(logging.ERROR,
+                    "Unknown destination id for \"send\" message: "
+                           + json.dumps(data))
+                client.sendResult({"error": "wrong parameters"})
+                return
+
+        if multiple:
+            response = self.registry.sendSharedMessage(
+                srcId, dstIds, str(data['msg']))
+            client.sendResult({"result": response})
+            return
+
+        dstId = dstIds[0]
+
+        # Message and copy will be sent in chunks
+        if chunked:
+            if len(client.uploads) >= MAX_UPLOADS:
+                logger.log(logging.ERROR,
+                    "Too many pending uploads for %s" % client)
+                client.sendResult({"error": "too many uploads"})
+                return
+
+            upload = self.registry.openUpload(srcId, dstId)
+            client.uploads.add(upload)
+            client.sendResult({"result": upload})
             return
 
         # Save message and copy
-        response = self.registry.sendMessage(srcId, dstId, msg, copy)
+        response = self.registry.sendMessage(
+            srcId, dstId, str(data['msg']), str(data['copy']))
 
         client.sendResult({"result": response})
 
+    def processChunk(self, data, client):
+        logger.log(logging.DEBUG, "Chunk for upload %r" % data.get('upload'))
+
+        upload = str(data.get('upload'))
+        if upload not in client.uploads:
+            logger.log(logging.ERROR,
+                "Unknown upload for \"chunk\" message: %r" % upload)
+            client.sendResult({"error": "wrong parameters"})
+            return
+
+        # Last chunk, move message and copy into the boxes
+        if data.get('commit', False):
+            client.uploads.remove(upload)
+            response = self.registry.commitUpload(upload)
+            client.sendResult({"result": response})
+            return
+
+        if not set({'part', 'data'}).issubset(set(data.keys())) \
+                or data['part'] not in ['msg', 'copy']:
+            logger.log(logging.ERROR, "Badly formated \"chunk\" message for "
+                "upload %r" % upload)
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        chunk = str(data['data'])
+        if self.registry.uploadsSize(client.uploads) + len(chunk) \
+                > MAX_UPLOADS_SIZE \
+                or not self.registry.appendUpload(upload, data['part'], chunk):
+            client.uploads.remove(upload)
+            self.registry.abortUpload(upload)
+            client.sendResult({"error": "message too large"})
+            return
+
+        client.sendResult({"result": len(chunk)})
+
     def processRecv(self, data, client):
         logger.log(logging.DEBUG, "%s" % json.dumps(data))
 
+        if 'msgs' in data or 'limit' in data:
+            self.processBulkRecv(data, client)
+            return
+
         if not set({'id', 'msg'}).issubset(set(data.keys())):
             logger.log(logging.ERROR, "Badly formated \"recv\" message: " +
                 json.dumps(data))
             client.sendResult({"error": "wrong message format"})
+            return
 
         fromId = int(data['id'])
         msg = str(data['msg'])
 
+        if not self.registry.validMessageName(msg):
+            logger.log(logging.ERROR,
+                "Invalid msg for \"recv\" message: " + json.dumps(data))
+            client.sendResult({"error": "wrong parameters"})
+            return
+
         if not self.registry.userExists(fromId):
             logger.log(logging.ERROR,
                 "Unknown source id for \"recv\" message: " + json.dumps(data))
@@ -243,13 +565,108 @@ class ServerActions:
             client.sendResult({"error": "wrong parameters"})
             return
 
+        # Read message in bounded chunks
+        if 'offset' in data:
+            try:
+                offset = int(data['offset'])
+            except (TypeError, ValueError):
+                client.sendResult({"error": "wrong message format"})
+                return
+
+            if offset < 0:
+                client.sendResult({"error": "wrong parameters"})
+                return
+
+            chunk, size = self.registry.readMsgChunk(
+                fromId, msg, offset, CHUNK_SIZE)
+            sender_id = int(re.match("_?([0-9]+)_[0-9]+", msg).group(1))
+
+            response = {
+                "result": [str(sender_id), chunk],
+                "offset": offset + len(chunk),
+                "size": size
+            }
+
+            # Sender resources are only needed once
+            if offset == 0:
+                response["resources"] = {
+                    'result': [self.get_user_resources(
+                        sender_id, data.get('versions'))]
+                }
+
+            client.sendResult(response)
+            return
+
         # Read message
         response = self.registry.recvMessage(fromId, msg)
         sender_id = int(response[0])
 
         client.sendResult({
             "result": response,
-            "resources": {'result': [self.get_user_resources(sender_id)]}
+            "resources": {'result': [self.get_user_resources(
+                sender_id, data.get('versions'))]}
+        })
+
+    def processBulkRecv(self, data, client):
+        if 'id' not in data:
+            logger.log(logging.ERROR, "Badly formated \"recv\" message: " +
+                json.dumps(data))
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        fromId = int(data['id'])
+
+        if not self.registry.userExists(fromId) \
+                or self.registry.getUser(client.secure.uuid).id != fromId:
+            logger.log(logging.ERROR,
+                "Invalid source id for \"recv\" message: " + json.dumps(data))
+            client.sendResult({"error": "wrong parameters"})
+            return
+
+        # Either the given messages or the first unread ones
+        if 'msgs' in data:
+            msgs = data['msgs']
+            if not isinstance(msgs, list):
+                client.sendResult({"error": "wrong message format"})
+                return
+            msgs = [str(msg) for msg in msgs]
+        else:
+            msgs = sorted(self.registry.userNewMessages(fromId),
+                          key=MailboxIndex.sortKey)[:max(int(data['limit']), 0)]
+
+        if len(msgs) > MAX_BATCH_SIZE:
+            client.sendResult({"error": "too many messages"})
+            return
+
+        valid = [msg for msg in msgs
+                 if self.registry.validMessageName(msg)
+                 and self.registry.messageExists(fromId, msg)]
+        messages = dict(zip(valid, self.registry.recvMessages(
+            fromId, valid, CHUNK_SIZE)))
+
+        # Each message is answered as a recv with offset, and the resources
+        # of every sender are sent only once
+        result = []
+        senders = set()
+        for msg in msgs:
+            if messages.get(msg) is None:
+                result.append({"msg": msg, "error": "wrong parameters"})
+                continue
+
+            sender_id, chunk, size = messages[msg]
+            senders.add(int(sender_id))
+            result.append({
+                "msg": msg,
+                "result": [sender_id, chunk],
+                "offset": len(chunk),
+                "size": size
+            })
+
+        client.sendResult({
+            "result": result,
+            "resources": {'result': [
+                self.get_user_resources(sender, data.get('versions'))
+                for sender in sorted(senders)]}
         })
 
     def processReceipt(self, data, client):
@@ -284,6 +701,10 @@ class ServerActions:
     def processStatus(self, data, client):
         logger.log(logging.DEBUG, "%s" % json.dumps(data))
 
+        if 'msgs' in data:
+            self.processBulkStatus(data, client)
+            return
+
         if not set({'id', 'msg'}).issubset(set(data.keys())):
             logger.log(logging.ERROR, "Badly formated \"status\" message: " +
                 json.dumps(data))
@@ -315,10 +736,52 @@ class ServerActions:
         client.sendResult(
             {
                 "result": response,
-                "resources": {'result': [self.get_user_resources(dest_id)]}
+                "resources": {'result': [self.get_user_resources(
+                    dest_id, data.get('versions'))]}
             }
         )
 
+    def processBulkStatus(self, data, client):
+        if 'id' not in data or not isinstance(data['msgs'], list):
+            logger.log(logging.ERROR, "Badly formated \"status\" message: " +
+                json.dumps(data))
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        fromId = int(data['id'])
+        msgs = [str(msg) for msg in data['msgs']]
+
+        if self.registry.getUser(client.secure.uuid).id != fromId:
+            logger.log(
+                logging.ERROR,
+                "Source id different from client id for \"status\" message: "
+                + json.dumps(data)
+            )
+            client.sendResult({"error": "wrong parameters"})
+            return
+
+        if len(msgs) > MAX_BATCH_SIZE:
+            client.sendResult({"error": "too many messages"})
+            return
+
+        valid = [msg for msg in msgs if re.match("([0-9]+)_[0-9]+$", msg)
+                 and self.registry.copyExists(fromId, msg)]
+        receipts = self.registry.getAllReceipts(fromId, valid)
+
+        # The resources of every receiver are sent only once
+        result = {}
+        for msg in msgs:
+            result[msg] = receipts[msg] if msg in receipts \
+                else {"error": "wrong parameters"}
+
+        dest_ids = sorted(set(int(msg.split("_")[0]) for msg in valid))
+        client.sendResult({
+            "result": result,
+            "resources": {'result': [
+                self.get_user_resources(dest_id, data.get('versions'))
+                for dest_id in dest_ids]}
+        })
+
     def processResource(self, data, client):
         logger.log(logging.DEBUG, "%s" % json.dumps(data))
 
@@ -329,7 +792,7 @@ class ServerActions:
 
         result = []
         for user in data['ids']:
-            result += [self.get_user_resources(user)]
+            result += [self.get_user_resources(user, data.get('versions'))]
 
         client.sendResult({"result": result})
 
@@ -340,12 +803,77 @@ class ServerActions:
         user_id = me.id if me is not None else ''
         client.sendResult({"result": user_id})
 
+    def processSubscribe(self, data, client):
+        logger.log(logging.DEBUG, "%s" % json.dumps(data))
+
+        if not set({'secdata'}).issubset(set(data.keys())) \
+                or not set({'dhpubvalue', 'salt', 'nonce'}).issubset(
+                    set(data['secdata'].keys())):
+            logger.log(logging.ERROR, "Badly formated \"subscribe\" message: "
+                + json.dumps(data))
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        me = self.registry.getUser(client.secure.uuid)
+        if me is None:
+            logger.log(logging.ERROR,
+                "Unknown client for \"subscribe\" message: " + json.dumps(data))
+            client.sendResult({"error": "wrong parameters"})
+            return
+
+        client.secure.setup_event_channel(data['secdata'])
+        self.subscribers.setdefault(me.id, set()).add(client)
+
+        client.sendResult({"result": me.id})
+
+    def processBatch(self, data, client):
+        logger.log(logging.DEBUG, "Batch with %d requests" %
+            len(data.get('requests', [])))
+
+        if not isinstance(data.get('requests'), list) \
+                or len(data['requests']) > MAX_BATCH_SIZE:
+            logger.log(logging.ERROR, "Badly formated \"batch\" message")
+            client.sendResult({"error": "wrong message format"})
+            return
+
+        # Every request is handled as usual, and all results are sent back
+        # together, in the same order
+        results = []
+        for req in data['requests']:
+            if not isinstance(req, dict) \
+                    or req.get('type') not in self.messageTypes \
+                    or req['type'] in self.unbatchedTypes:
+                logger.log(logging.ERROR, "Invalid request in batch: %r" %
+                    (req.get('type') if isinstance(req, dict) else req))
+                results.append({"error": "unknown request"})
+                continue
+
+            batch_client = BatchClient(client)
+            try:
+                self.messageTypes[req['type']](req, batch_client)
+            except Exception:
+                logging.exception("Could not handle request in batch")
+                batch_client.results.append({"error": "wrong message format"})
+
+            results.append(batch_client.results[-1]
+                           if batch_client.results else None)
+
+        client.sendResult({"result": results})
+
     def processError(self, data, client):
         logger.log(logging.DEBUG, "%s" % json.dumps(data))
 
         client.sendResult(data)
 
-    def get_user_resources(self, user):
+    def get_user_resources(self, user, versions=None):
+        # Resources the client already has are not sent again
+        version = self.registry.users[user].version \
+            if user in self.registry.users else None
+
+        if isinstance(versions, dict) and version is not None \
+                and versions.get(str(user)) == version:
+            return {'id': user, 'version': version, 'unchanged': True}
+
         sec_data = self.registry.users[user]['description']['secdata'] \
             if user in self.registry.users else None
 
@@ -355,7 +883,8 @@ class ServerActions:
         result = {
             'id': user,
             'secdata': sec_data,
-            'signature': signature
+            'signature': signature,
+            'version': version
         }
 
         return result
@@ -0,0 +1,169 @@
+from log import logger
+from lib import *
+import os
+import logging
+import re
+import json
+import zipfile
+import time
+
+
+class MessageArchive:
+    """Compressed pack files holding old entries of a message or receipt box.
+
+    Each pack is a deflated zip file, and the archive index maps every
+    archived entry name to the pack that holds it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        self.load()
+
+    def indexFile(self):
+        return os.path.join(self.path, INDEX_FILENAME)
+
+    def packFile(self, pack):
+        return os.path.join(self.path, pack)
+
+    def load(self):
+        path = self.indexFile()
+
+        if not os.path.exists(path):
+            return
+
+        try:
+            with open(path) as f:
+                self.entries = json.loads(f.read())['entries']
+        except:
+            logging.exception("Cannot load archive index from " + path)
+
+    def save(self):
+        path = self.indexFile()
+        tmp = path + ".tmp"
+
+        with open(tmp, "w") as f:
+            f.write(json.dumps({'entries': self.entries}))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, path)
+
+    def packs(self):
+        return sorted(set(self.entries.values()),
+                      key=lambda p: int(re.match("pack_([0-9]+)", p).group(1)))
+
+    def newPack(self):
+        packs = self.packs()
+        nr = int(re.match("pack_([0-9]+)", packs[-1]).group(1)) + 1 \
+            if packs else 1
+        return "pack_%d.zip" % nr
+
+    def contains(self, name):
+        return name in self.entries
+
+    def names(self, pattern=None):
+        return [name for name in self.entries
+                if pattern is None or re.match(pattern, name)]
+
+    def read(self, name):
+        logger.log(logging.DEBUG, "Read from archive: " + name)
+        with zipfile.ZipFile(self.packFile(self.entries[name])) as pack:
+            return pack.read(name).decode()
+
+    def info(self, name):
+        """Size and modification time of an archived entry.
+        """
+        with zipfile.ZipFile(self.packFile(self.entries[name])) as pack:
+            info = pack.getinfo(name)
+            return info.file_size, time.mktime(info.date_time + (0, 0, -1))
+
+    def readChunk(self, name, offset, size):
+        with zipfile.ZipFile(self.packFile(self.entries[name])) as pack:
+            total = pack.getinfo(name).file_size
+            with pack.open(name) as f:
+                f.seek(offset)
+                return f.read(size).decode(), total
+
+    def writePack(self, pack, entries):
+        """Write a new pack file with entries (name -> data) atomically.
+        """
+        path = self.packFile(pack)
+        tmp = path + ".tmp"
+
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as f:
+            for name in entries:
+                f.writestr(name, entries[name])
+
+        os.replace(tmp, path)
+
+    def store(self, entries):
+        """Pack the given entries (name -> data) into a new pack.
+        The caller is responsible for removing the original files.
+        """
+        if not entries:
+            return
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        pack = self.newPack()
+        logger.log(logging.DEBUG, "Archiving %d entries into %s" %
+            (len(entries), self.packFile(pack)))
+        self.writePack(pack, entries)
+
+        for name in entries:
+            self.entries[name] = pack
+        self.save()
+
+    def merge(self, max_bytes=COMPACT_MAX_BYTES):
+        """Once there are too many packs, rewrite the smallest ones into a
+        single one, reclaiming the space of stale and duplicated entries.
+        Each call rewrites at most max_bytes of packs (but at least two of
+        them), so merging is spread over several calls.
+        Returns the size of the packs rewritten.
+        """
+        old_packs = [p for p in os.listdir(self.path)
+                     if re.match("pack_[0-9]+\\.zip$", p)] \
+            if os.path.exists(self.path) else []
+
+        if len(old_packs) <= PACK_MERGE_THRESHOLD:
+            return 0
+
+        sizes = {p: os.path.getsize(self.packFile(p)) for p in old_packs}
+        merged = []
+        total = 0
+        for old_pack in sorted(old_packs, key=lambda p: sizes[p]):
+            if len(merged) >= 2 and total + sizes[old_pack] > max_bytes:
+                break
+
+            merged.append(old_pack)
+            total += sizes[old_pack]
+
+        entries = {}
+        for old_pack in merged:
+            names = [name for name in self.entries
+                     if self.entries[name] == old_pack]
+            if not names:
+                continue
+
+            with zipfile.ZipFile(self.packFile(old_pack)) as f:
+                for name in names:
+                    entries[name] = f.read(name).decode()
+
+        pack = self.newPack()
+        logger.log(logging.DEBUG, "Merging %d packs (%d bytes) into %s" %
+            (len(merged), total, self.packFile(pack)))
+        if entries:
+            self.writePack(pack, entries)
+
+            for name in entries:
+                self.entries[name] = pack
+            self.save()
+
+        for old_pack in merged:
+            if old_pack != pack:
+                os.remove(self.packFile(old_pack))
+
+        return total
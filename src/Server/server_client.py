@@ -19,6 +19,8 @@ class Client:
         self.bufout = ""
         self.addr = addr
         self.id = None
+        self.uploads = set()
+        self.wait = None
         self.secure = ServerSecure(registry=registry, certs=certs)
 
         # TODO: Apply security constraints
@@ -47,16 +49,29 @@ class Client:
         self.bufin = reqs[-1]
         return reqs[:-1]
 
-    def sendResult(self, obj):
-        """Send an object to this client.
+    def sendResult(self, obj, request=None):
+        """Send an object to this client, as the response to the given
+        request, or to the last one received.
         """
+        if request is None:
+            request = self.secure.current_request
+
         try:
             self.bufout += json.dumps(self.secure.encapsulate_secure_message(
-                json.dumps(obj))) + "\n\n"
+                json.dumps(obj), request)) + "\n\n"
         except:
             # It should never happen! And not be reported to the client!
             logging.exception("Client.send(%s)" % self)
 
+    def sendEvent(self, obj):
+        """Push an event to this client, outside of any request.
+        """
+        try:
+            self.bufout += json.dumps(self.secure.encapsulate_event_message(
+                json.dumps(obj))) + "\n\n"
+        except:
+            logging.exception("Client.sendEvent(%s)" % self)
+
     def close(self):
         """Shuts down and closes this client's socket.
         Will log error if called on a client with closed socket.
@@ -67,3 +82,19 @@ class Client:
             self.socket.close()
         except:
             logging.exception("Client.close(%s)" % self)
+
+
+class BatchClient:
+    """Stands for a client while handling a request of a batch, collecting
+    its results instead of sending them.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.results = []
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def sendResult(self, obj, request=None):
+        self.results.append(obj)
@@ -0,0 +1,249 @@
+from log import logger
+from lib import *
+import os
+import logging
+import re
+import json
+
+
+class MailboxIndex:
+    """Per-user mailbox state kept in memory and persisted next to the
+    messages, so message files never have to be renamed or moved.
+
+    Every change to the messages of the user (received, read, sent or
+    receipted) gets the next number of a change sequence, and the last
+    CHANGE_LOG_SIZE changes are kept so clients can sync from a cursor.
+    The same changes keep the message counters of the user up to date.
+
+    Received messages also have their size, arrival time and sender kept
+    in the index, so they can be listed without reading them. Messages
+    moved to the archive are forgotten.
+
+    Changes are appended to a journal next to the index, which is only
+    rewritten once the journal has INDEX_JOURNAL_SIZE entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.read = set()
+        self.seq = 0
+        self.changes = []
+        self.counts = None
+        self.pending = set()
+        self.messages = {}
+        self.journalSize = 0
+
+        self.load()
+
+    @staticmethod
+    def sortKey(msg):
+        return tuple(int(n) for n in msg.split("_"))
+
+    def indexFile(self):
+        return os.path.join(self.path, INDEX_FILENAME)
+
+    def journalFile(self):
+        return os.path.join(self.path, INDEX_FILENAME + ".log")
+
+    def load(self):
+        path = self.indexFile()
+
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    index = json.loads(f.read())
+                self.read = set(index['read'])
+                self.seq = index.get('seq', 0)
+                self.changes = index.get('changes', [])
+                self.counts = index.get('counts')
+                self.pending = set(index.get('pending', []))
+                self.messages = index.get('messages', {})
+            except:
+                logging.exception("Cannot load mailbox index from " + path)
+
+        self.loadJournal()
+        self.migrate()
+
+    def loadJournal(self):
+        path = self.journalFile()
+
+        if not os.path.exists(path):
+            return
+
+        torn = False
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Interrupted while appending, nothing after it
+                    logger.log(logging.ERROR, "Torn entry in " + path)
+                    torn = True
+                    break
+
+                # Entries already in the index, when it was rewritten
+                # but the journal was not yet truncated
+                changes = [change for change in entry['changes']
+                           if change[0] > self.seq]
+                self.apply(changes, entry['messages'])
+                self.journalSize += 1
+
+        if torn:
+            self.save()
+
+    def migrate(self):
+        """Message files were previously marked as read by renaming them
+        with a "_" prefix. Move them back and record them in the index.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        migrated = False
+        for filename in os.listdir(self.path):
+            if not re.match("_[0-9]+_[0-9]+$", filename):
+                continue
+
+            msg = filename[1:]
+            src = os.path.join(self.path, filename)
+            dst = os.path.join(self.path, msg)
+
+            if os.path.exists(dst):
+                logger.log(logging.ERROR,
+                    "Cannot migrate " + src + ", " + dst + " already exists")
+                continue
+
+            logger.log(logging.DEBUG, "Migrating read message " + src)
+            os.rename(src, dst)
+            self.read.add(msg)
+            migrated = True
+
+        if migrated:
+            self.save()
+
+    def save(self):
+        """Atomically replace the index file, and empty the journal it
+        now includes.
+        """
+        path = self.indexFile()
+        tmp = path + ".tmp"
+
+        with open(tmp, "w") as f:
+            f.write(json.dumps({
+                'read': sorted(self.read, key=MailboxIndex.sortKey),
+                'seq': self.seq,
+                'changes': self.changes,
+                'counts': self.counts,
+                'pending': sorted(self.pending, key=MailboxIndex.sortKey),
+                'messages': self.messages
+            }))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, path)
+
+        if self.journalSize or os.path.exists(self.journalFile()):
+            open(self.journalFile(), "w").close()
+            self.journalSize = 0
+
+    def append(self, entry):
+        with open(self.journalFile(), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.journalSize += 1
+
+    def isRead(self, msg):
+        return msg in self.read
+
+    def markRead(self, msg):
+        return len(self.markAllRead([msg])) > 0
+
+    def markAllRead(self, msgs):
+        """Mark several messages as read with a single index update.
+        Returns the messages that were not read before.
+        """
+        marked = [msg for msg in set(msgs) if msg not in self.read]
+        if not marked:
+            return []
+
+        logger.log(logging.DEBUG, "Marking messages " + ", ".join(marked) +
+            " as read")
+        self.recordAll([('read', msg) for msg in marked])
+        return marked
+
+    def forget(self, msgs):
+        """Drop the state of messages moved to the archive.
+        """
+        self.read.difference_update(msgs)
+        for msg in msgs:
+            self.messages.pop(msg, None)
+
+        self.save()
+
+    def setCounts(self, total, unread, sent, pending):
+        """Initialize the counters, for mailboxes created before them.
+        """
+        self.counts = {'total': total, 'unread': unread, 'sent': sent}
+        self.pending = set(pending)
+        self.save()
+
+    def getCounts(self):
+        counts = dict(self.counts)
+        counts['pending'] = len(self.pending)
+        return counts
+
+    def count(self, kind, msg):
+        if kind == 'recv':
+            self.counts['total'] += 1
+            self.counts['unread'] += 1
+        elif kind == 'read':
+            self.counts['unread'] -= 1
+        elif kind == 'sent':
+            self.counts['sent'] += 1
+            self.pending.add(msg)
+        elif kind == 'receipt':
+            self.pending.discard(msg)
+
+    def record(self, kind, msg, meta=None):
+        self.recordAll([(kind, msg)], {msg: meta} if meta is not None else None)
+
+    def recordAll(self, changes, messages=None):
+        """Append changes to the change log, along with the metadata of new
+        messages. They are journaled before being applied, so nothing
+        changes if they can't be saved.
+        """
+        messages = messages or {}
+        changes = [[self.seq + i + 1, kind, msg]
+                   for i, (kind, msg) in enumerate(changes)]
+
+        self.append({'changes': changes, 'messages': messages})
+        self.apply(changes, messages)
+
+        if self.journalSize >= INDEX_JOURNAL_SIZE:
+            try:
+                self.save()
+            except:
+                logging.exception("Cannot save mailbox index of " + self.path)
+
+    def apply(self, changes, messages):
+        self.messages.update(messages)
+
+        for seq, kind, msg in changes:
+            if kind == 'read':
+                self.read.add(msg)
+            if self.counts is not None:
+                self.count(kind, msg)
+            self.seq = seq
+
+        self.changes = (self.changes + changes)[-CHANGE_LOG_SIZE:]
+
+    def changesSince(self, cursor):
+        """Changes after cursor, or None if they are no longer all in the
+        change log.
+        """
+        first = self.changes[0][0] if self.changes else self.seq + 1
+        if cursor > self.seq or cursor < first - 1:
+            return None
+
+        return [change for change in self.changes if change[0] > cursor]
@@ -1,11 +1,15 @@
 from log import logger
 from lib import *
+from server_mailbox import *
+from server_archive import *
 import os
 import sys
 import logging
 import re
 import json
 import time
+import hashlib
+import bisect
 
 sys.tracebacklimit = 30
 
@@ -16,6 +20,21 @@ class UserDescription(dict):
         dict.__init__(self, id=uid, description=description)
         self.id = uid
         self.description = description
+        self.version = UserDescription.versionOf(description)
+
+    @staticmethod
+    def versionOf(description):
+        """Tag identifying the public resources of a user, so clients can
+        skip fetching the ones they already have.
+        """
+        if description is None:
+            return None
+
+        digest = hashlib.sha256()
+        for field in ['secdata', 'signature']:
+            digest.update(str(description.get(field)).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
 
 
 class ServerRegistry:
@@ -23,8 +42,18 @@ class ServerRegistry:
     def __init__(self):
 
         self.users = {}
-
-        for dirname in [MBOXES_PATH, RECEIPTS_PATH]:
+        self.userIds = []
+        self.mailboxes = {}
+        self.archives = {}
+        self.compactCursor = 0
+        self.uploads = {}
+        self.uploadCount = 0
+        self.bodyRefs = {}
+        self.sharedEntries = {}
+        self.listeners = []
+
+        for dirname in [MBOXES_PATH, RECEIPTS_PATH, ARCHIVES_PATH,
+                        UPLOADS_PATH, BODIES_PATH]:
             try:
                 if not os.path.exists(dirname):
                     logging.debug("Creating " + dirname)
@@ -33,6 +62,11 @@ class ServerRegistry:
                 logging.exception("Cannot create directory " + dirname)
                 sys.exit(1)
 
+        # Uploads not committed before a restart can't be resumed
+        for entryname in os.listdir(UPLOADS_PATH):
+            logging.info("Removing stale upload " + entryname)
+            os.remove(os.path.join(UPLOADS_PATH, entryname))
+
         for entryname in os.listdir(MBOXES_PATH):
             logging.info("Found " + entryname)
 
@@ -57,6 +91,31 @@ class ServerRegistry:
                     sys.exit(1)
 
                 self.users[uid] = UserDescription(uid, description)
+                bisect.insort(self.userIds, uid)
+
+        self.loadRetentionPolicies()
+        self.loadSharedBodies()
+
+    def loadRetentionPolicies(self):
+        """Policies are read from RETENTION_PATH, with the format
+        {"default": seconds, "users": {"<uid>": seconds}}.
+        A null retention keeps messages in the mailbox forever.
+        """
+        self.retention = {'default': RETENTION_DEFAULT, 'users': {}}
+
+        if not os.path.exists(RETENTION_PATH):
+            return
+
+        try:
+            with open(RETENTION_PATH) as f:
+                self.retention.update(json.loads(f.read()))
+        except:
+            logging.exception(
+                "Cannot load retention policies from " + RETENTION_PATH)
+
+    def retentionFor(self, uid):
+        return self.retention['users'].get(str(uid),
+                                           self.retention['default'])
 
     def saveOnFile(self, path, data):
         with open(path, "w") as f:
@@ -67,19 +126,207 @@ class ServerRegistry:
         with open(path, "r") as f:
             return f.read()
 
-    def messageWasRed(self, uid, msg):
+    def saveOnFileAtomic(self, path, data):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, path)
+
+    def loadSharedBodies(self):
+        path = os.path.join(BODIES_PATH, INDEX_FILENAME)
+
+        if not os.path.exists(path):
+            return
+
+        try:
+            index = json.loads(self.readFromFile(path))
+        except:
+            logging.exception("Cannot load shared bodies index from " + path)
+            sys.exit(1)
+
+        if 'refs' not in index:
+            # Entries used to point to their body from their own content,
+            # which clients control, so those pointers are not followed
+            logger.log(logging.ERROR, "Ignoring shared body references of "
+                "an old index: " + path)
+            index = {'refs': index, 'entries': {}}
+
+        self.bodyRefs = index['refs']
+        self.sharedEntries = index['entries']
+
+    def saveSharedBodies(self):
+        self.saveOnFileAtomic(os.path.join(BODIES_PATH, INDEX_FILENAME),
+                              json.dumps({'refs': self.bodyRefs,
+                                          'entries': self.sharedEntries}))
+
+    def bodyFile(self, body):
+        return os.path.join(BODIES_PATH, body)
+
+    def storeSharedBody(self, msg, refs):
+        """Store a message body referenced by several box entries.
+        """
+        body = self.newFile(os.path.join(BODIES_PATH, ""))
+        self.saveOnFile(self.bodyFile(body), msg)
+
+        self.bodyRefs[body] = refs
+        self.saveSharedBodies()
+
+        logger.log(logging.DEBUG, "Stored shared body %s with %d references"
+            % (body, refs))
+        return body
+
+    def entryKey(self, path):
+        return os.path.relpath(path, DIR_PATH)
+
+    def shareEntries(self, paths, body):
+        """Make box entries refer to a shared body.
+        The references are only kept in the shared bodies index, never in
+        the entries, whose content comes from clients.
+        """
+        for path in paths:
+            self.sharedEntries[self.entryKey(path)] = body
+
+        try:
+            self.saveSharedBodies()
+        except:
+            for path in paths:
+                del self.sharedEntries[self.entryKey(path)]
+            raise
+
+    def releaseSharedEntries(self, paths):
+        """Drop the references of box entries that no longer exist to
+        their shared bodies, removing the bodies no longer referenced.
+        """
+        bodies = [self.sharedEntries.pop(self.entryKey(path))
+                  for path in paths if self.entryKey(path) in self.sharedEntries]
+        self.releaseBodies(bodies)
+
+    def releaseBodies(self, bodies):
+        """Drop one reference to each of the given shared bodies, removing
+        the bodies no longer referenced.
+        """
+        if not bodies:
+            return
+
+        removed = []
+        for body in bodies:
+            if body not in self.bodyRefs:
+                continue
+            self.bodyRefs[body] -= 1
+            if self.bodyRefs[body] <= 0:
+                del self.bodyRefs[body]
+                removed.append(body)
+
+        self.saveSharedBodies()
+
+        for body in removed:
+            logger.log(logging.DEBUG, "Removing shared body " + body)
+            if os.path.exists(self.bodyFile(body)):
+                os.remove(self.bodyFile(body))
+
+    def sharedBody(self, path):
+        """Return the shared body referenced by a box entry, if any.
+        """
+        return self.sharedEntries.get(self.entryKey(path))
+
+    def entryFile(self, path):
+        """File with the data of a box entry, which is the shared body
+        file for shared entries.
+        """
+        body = self.sharedBody(path)
+        return path if body is None else self.bodyFile(body)
+
+    def mailbox(self, uid):
+        uid = int(uid)
+        if uid not in self.mailboxes:
+            self.mailboxes[uid] = MailboxIndex(self.userMessageBox(uid))
+
+        return self.mailboxes[uid]
+
+    def countMessages(self, uid):
+        """Initialize the counters of a mailbox from its files. Until then,
+        changes are not counted, as the files already reflect them.
+        """
+        logger.log(logging.DEBUG, "Counting messages of user %d" % uid)
+
+        sent = self.userSentMessages(uid)
+        receipted = set()
+        pattern = re.compile("_(([0-9]+)_[0-9]+)_([0-9]+)$")
+        boxdir = self.userReceiptBox(uid)
+        fnames = set(os.listdir(boxdir) if os.path.exists(boxdir) else []) \
+            | set(self.receiptArchive(uid).names())
+        for fname in fnames:
+            m = pattern.match(fname)
+            if m:
+                receipted.add(m.group(1))
+
+        self.mailbox(uid).setCounts(
+            len(self.userAllMessages(uid)),
+            len(self.userNewMessages(uid)),
+            len(sent),
+            [copy for copy in sent if copy not in receipted])
+
+    def messageCounts(self, uid):
+        if self.mailbox(uid).counts is None:
+            self.countMessages(uid)
+
+        return self.mailbox(uid).getCounts()
+
+    def messageName(self, msg):
+        # Read messages are listed with a "_" prefix, but stored without it
         msg = str(msg)
+        return msg[1:] if msg.startswith("_") else msg
 
-        if msg.startswith("_"):
-            return os.path.exists(os.path.join(self.userMessageBox(uid), msg))
-        else:
-            return os.path.exists(os.path.join(self.userMessageBox(uid), "_" + msg))
+    def messageArchive(self, uid):
+        return self.archive(os.path.join(ARCHIVES_PATH, "mboxes", str(uid)))
+
+    def receiptArchive(self, uid):
+        return self.archive(os.path.join(ARCHIVES_PATH, "receipts", str(uid)))
+
+    def archive(self, path):
+        if path not in self.archives:
+            self.archives[path] = MessageArchive(path)
+
+        return self.archives[path]
+
+    def messageWasRed(self, uid, msg):
+        msg = self.messageName(msg)
+        return self.messageExists(uid, msg) and self.isRead(uid, msg)
+
+    def isRead(self, uid, msg):
+        # Only read messages are archived, and then the index forgets them
+        return self.mailbox(uid).isRead(msg) \
+            or self.messageArchive(uid).contains(msg)
+
+    def markRead(self, uid, msgs):
+        """Mark messages as read, leaving out those already read, which
+        include the archived ones the mailbox index no longer knows.
+        """
+        unread = [msg for msg in msgs if not self.isRead(uid, msg)]
+        if not unread:
+            return
+
+        try:
+            self.mailbox(uid).markAllRead(unread)
+        except:
+            logging.exception("Cannot mark messages of user " + str(uid) +
+                              " as read")
+
+    def validMessageName(self, msg):
+        # Names come from clients, and end up in paths
+        return re.fullmatch("_?[0-9]+_[0-9]+", str(msg)) is not None
 
     def messageExists(self, uid, message):
-        return os.path.exists(os.path.join(self.userMessageBox(uid), message))
+        message = self.messageName(message)
+        return os.path.exists(os.path.join(self.userMessageBox(uid), message)) \
+            or self.messageArchive(uid).contains(message)
 
     def copyExists(self, uid, message):
-        return os.path.exists(os.path.join(self.userReceiptBox(uid), message))
+        return os.path.exists(os.path.join(self.userReceiptBox(uid), message)) \
+            or self.receiptArchive(uid).contains(message)
 
     def userExists(self, uid):
         return self.getUser(uid) is not None
@@ -110,6 +357,7 @@ class ServerRegistry:
 
         user = UserDescription(uid, description)
         self.users[uid] = user
+        bisect.insort(self.userIds, uid)
 
         for path in [self.userMessageBox(uid), self.userReceiptBox(uid)]:
             try:
@@ -129,7 +377,10 @@ class ServerRegistry:
 
         return user
 
-    def listUsers(self, uid):
+    def listUsers(self, uid, cursor=0, limit=None):
+        """List one user, or the users with an id greater than cursor, up to
+        limit of them, in id order.
+        """
         if uid == 0:
             logger.log(logging.DEBUG, "Looking for all connected users")
         else:
@@ -142,20 +393,27 @@ class ServerRegistry:
                 return [user]
             return None
 
-        userList = []
-        for k in list(self.users.keys()):
-            userList.append(self.users[k])
+        start = bisect.bisect_right(self.userIds, cursor)
+        end = len(self.userIds) if limit is None else start + limit
 
-        return userList
+        return [self.users[k] for k in self.userIds[start:end]]
 
     def userAllMessages(self, uid):
-        return self.userMessages(self.userMessageBox(uid), "_?[0-9]+_[0-9]+")
+        mailbox = self.mailbox(uid)
+        return [("_" + msg) if mailbox.isRead(msg) else msg
+                for msg in self.userMessages(self.userMessageBox(uid),
+                                             "[0-9]+_[0-9]+$")] \
+            + ["_" + msg for msg in self.messageArchive(uid).names()]
 
     def userNewMessages(self, uid):
-        return self.userMessages(self.userMessageBox(uid), "[0-9]+_[0-9]+")
+        mailbox = self.mailbox(uid)
+        return [msg for msg in self.userMessages(self.userMessageBox(uid),
+                                                 "[0-9]+_[0-9]+$")
+                if not mailbox.isRead(msg)]
 
     def userSentMessages(self, uid):
-        return self.userMessages(self.userReceiptBox(uid), "[0-9]+_[0-9]+")
+        return self.userMessages(self.userReceiptBox(uid), "[0-9]+_[0-9]+$") \
+            + self.receiptArchive(uid).names("[0-9]+_[0-9]+$")
 
     def userMessages(self, path, pattern):
         logger.log(logging.DEBUG, "Look for files at " +
@@ -176,52 +434,319 @@ class ServerRegistry:
 
         return messageList
 
-    def newFile(self, basename):
+    def newFile(self, basename, archive=None):
         i = 1
         while True:
-            path = os.path.join(basename, str(i))
-            if not os.path.exists(path):
+            path = basename + str(i)
+            if not os.path.exists(path) and (archive is None or
+                    not archive.contains(os.path.basename(path))):
                 return str(i)
 
             i += 1
 
-    def sendMessage(self, src, dst, msg, receipt):
+    def commitFiles(self, files):
+        """Move temporary files into place, given as (tmp, path) pairs.
+        Either all of them are moved, or none.
+        """
+        done = []
+        try:
+            for tmp, path in files:
+                os.replace(tmp, path)
+                done.append(path)
+        except:
+            for path in done:
+                os.remove(path)
+            raise
+        finally:
+            for tmp, path in files:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def sendMessage(self, src, dst, msg, receipt, body=None):
+        """Store a message and its sender copy, or references to a shared
+        body, when given, for both.
+        """
         nr = "0"
         src = str(src)
         dst = str(dst)
 
+        # The message and the copy are written to temporary files first,
+        # so a failure never leaves just one of them
+        msgPath = os.path.join(self.userMessageBox(dst), src + "_")
+        copyPath = os.path.join(self.userReceiptBox(src), dst + "_")
+        files = []
         try:
-            path = os.path.join(self.userMessageBox(dst), src + "_")
-            nr = self.newFile(path)
-            self.saveOnFile(path + nr, msg)
+            nr = self.newFile(msgPath, self.messageArchive(dst))
+            msgPath += nr
+            copyPath += nr
+
+            for data, path in [(msg, msgPath), (receipt, copyPath)]:
+                files.append((path + ".tmp", path))
+                self.saveOnFile(path + ".tmp", data)
 
-            result = [src + "_" + nr]
-            path = os.path.join(self.userReceiptBox(src), dst + "_")
-            self.saveOnFile(path + nr, receipt)
+            # New entries never exist yet, so references left to them
+            # by a reset are stale
+            self.releaseSharedEntries([msgPath, copyPath])
+            self.commitFiles(files)
+
+            if body is not None:
+                try:
+                    self.shareEntries([msgPath, copyPath], body)
+                except:
+                    for tmp, path in files:
+                        os.remove(path)
+                    raise
         except:
             logging.exception(
-                "Cannot create message or receipt file " + path + nr)
+                "Cannot create message or receipt file " + msgPath)
+            for tmp, path in files:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
             return ["", ""]
 
-        result.append(dst + "_" + nr)
+        result = [src + "_" + nr, dst + "_" + nr]
+        self.messageLanded(src, dst, result[0])
         return result
 
-    def readMsgFile(self, uid, msg):
-        path = self.userMessageBox(uid)
+    def addListener(self, listener):
+        """Register a callable to be notified, with the destination user id
+        and an event description, whenever a message lands in a mailbox.
+        """
+        self.listeners.append(listener)
 
-        if msg.startswith('_'):
-            path = os.path.join(path, msg)
+    def messageLanded(self, src, dst, msg):
+        try:
+            meta = self.messageMeta(dst, msg, time.time())
+        except:
+            logging.exception("Cannot get metadata of message " + msg)
+            meta = None
+
+        # Both the receiver mailbox and the sender copies changed
+        self.recordChange(dst, 'recv', msg, meta)
+        self.recordChange(src, 'sent', "%s_%s" % (dst, msg.split("_")[1]))
+
+        event = {'event': 'new', 'src': int(src), 'msg': msg}
+
+        for listener in self.listeners:
+            try:
+                listener(int(dst), event)
+            except:
+                logging.exception("Cannot notify mailbox listener")
+
+    def recordChange(self, uid, kind, msg, meta=None):
+        try:
+            self.mailbox(uid).record(kind, msg, meta)
+        except:
+            logging.exception("Cannot record change of user %s" % uid)
+
+    def userChanges(self, uid, cursor):
+        """Messages received, read, sent or receipted after cursor, listed
+        as in userAllMessages and userSentMessages.
+        Returns None if the cursor is too old.
+        """
+        mailbox = self.mailbox(uid)
+        changes = mailbox.changesSince(cursor)
+        if changes is None:
+            return None
+
+        received = []
+        sent = []
+        for seq, kind, msg in changes:
+            if kind in ['recv', 'read']:
+                msg = ("_" + msg) if self.isRead(uid, msg) else msg
+                if msg not in received:
+                    received.append(msg)
+            elif msg not in sent:
+                sent.append(msg)
+
+        return [received, sent]
+
+    def messageMeta(self, uid, msg, arrival=None):
+        """Sender, size and arrival time (in milliseconds) of a received
+        message, from its file when not in the mailbox index.
+        """
+        msg = self.messageName(msg)
+        mailbox = self.mailbox(uid)
+        if msg in mailbox.messages:
+            return mailbox.messages[msg]
+
+        path = os.path.join(self.userMessageBox(uid), msg)
+        if os.path.exists(path):
+            size = os.path.getsize(self.entryFile(path))
+            mtime = os.path.getmtime(path)
         else:
+            size, mtime = self.messageArchive(uid).info(msg)
+
+        return {
+            'src': int(msg.split("_")[0]),
+            'size': size,
+            'time': int((mtime if arrival is None else arrival) * 1000)
+        }
+
+    def messageRecords(self, uid, msgs):
+        """Listing records of received messages, as listed by
+        userAllMessages or userNewMessages.
+        Metadata missing from the mailbox index is added to it.
+        """
+        mailbox = self.mailbox(uid)
+        records = []
+        found = {}
+
+        for msg in msgs:
+            name = self.messageName(msg)
             try:
-                f = os.path.join(path, msg)
-                path = os.path.join(path, "_" + msg)
-                logger.log(logging.DEBUG, "Marking message " + msg + " as read")
-                os.rename(f, path)
+                meta = self.messageMeta(uid, name)
             except:
-                logging.exception("Cannot rename message file to " + path)
-                path = os.path.join(self.userMessageBox(str(uid)), msg)
+                logging.exception("Cannot get metadata of message " + msg)
+                continue
 
-        return self.readFromFile(path)
+            if name not in mailbox.messages \
+                    and not self.messageArchive(uid).contains(name):
+                found[name] = meta
+
+            record = dict(meta)
+            record['msg'] = msg
+            record['read'] = self.isRead(uid, name)
+            records.append(record)
+
+        if found:
+            try:
+                mailbox.recordAll([], found)
+            except:
+                logging.exception("Cannot save metadata of user %s" % uid)
+
+        return records
+
+    def sendSharedMessage(self, src, dsts, msg):
+        """Send one message body to several users. The body is stored once
+        and each message and receipt box only gets a reference to it.
+        """
+        try:
+            body = self.storeSharedBody(msg, 2 * len(dsts))
+        except:
+            logging.exception("Cannot store shared message body")
+            return [["", ""] for dst in dsts]
+
+        result = [self.sendMessage(src, dst, "", "", body) for dst in dsts]
+
+        # Each failed destination holds none of its two references
+        failed = len([r for r in result if r == ["", ""]])
+        try:
+            self.releaseBodies([body] * 2 * failed)
+        except:
+            logging.exception("Cannot release shared body " + body)
+
+        return result
+
+    def readMsgFile(self, uid, msg):
+        msg = self.messageName(msg)
+        path = os.path.join(self.userMessageBox(uid), msg)
+
+        self.markRead(uid, [msg])
+
+        if not os.path.exists(path):
+            return self.messageArchive(uid).read(msg)
+
+        return self.readFromFile(self.entryFile(path))
+
+    def readMsgChunk(self, uid, msg, offset, size, mark=True):
+        """Read at most size characters of a message starting at offset.
+        Returns the chunk and the total size of the message.
+        """
+        msg = self.messageName(msg)
+        path = os.path.join(self.userMessageBox(uid), msg)
+
+        if offset == 0 and mark:
+            self.markRead(uid, [msg])
+
+        if not os.path.exists(path):
+            return self.messageArchive(uid).readChunk(msg, offset, size)
+
+        path = self.entryFile(path)
+
+        logger.log(logging.DEBUG, "Read chunk from file: %s (%d, %d)" %
+            (path, offset, size))
+        with open(path, "rb") as f:
+            total = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            return f.read(size).decode(), total
+
+    def uploadFile(self, upload, part):
+        return os.path.join(UPLOADS_PATH, "%s_%s" % (upload, part))
+
+    def openUpload(self, src, dst):
+        """Start a chunked message upload. The message and its copy are
+        appended to temporary files, which are only moved into the message
+        and receipt boxes once the upload is committed.
+        """
+        self.uploadCount += 1
+        upload = str(self.uploadCount)
+
+        self.uploads[upload] = {'src': str(src), 'dst': str(dst), 'size': 0}
+        for part in ['msg', 'copy']:
+            self.saveOnFile(self.uploadFile(upload, part), "")
+
+        logger.log(logging.DEBUG, "Opened upload %s: %s -> %s" %
+            (upload, src, dst))
+        return upload
+
+    def appendUpload(self, upload, part, data):
+        entry = self.uploads[upload]
+
+        if entry['size'] + len(data) > MAX_MESSAGE_SIZE:
+            logger.log(logging.ERROR, "Upload %s exceeds MAX MESSAGE SIZE" %
+                upload)
+            return False
+
+        with open(self.uploadFile(upload, part), "a") as f:
+            f.write(data)
+
+        entry['size'] += len(data)
+        return True
+
+    def uploadsSize(self, uploads):
+        return sum(self.uploads[upload]['size'] for upload in uploads
+                   if upload in self.uploads)
+
+    def commitUpload(self, upload):
+        entry = self.uploads.pop(upload)
+        src = entry['src']
+        dst = entry['dst']
+        nr = "0"
+
+        msgPath = os.path.join(self.userMessageBox(dst), src + "_")
+        copyPath = os.path.join(self.userReceiptBox(src), dst + "_")
+        try:
+            nr = self.newFile(msgPath, self.messageArchive(dst))
+            self.releaseSharedEntries([msgPath + nr, copyPath + nr])
+            self.commitFiles([
+                (self.uploadFile(upload, 'msg'), msgPath + nr),
+                (self.uploadFile(upload, 'copy'), copyPath + nr)
+            ])
+        except:
+            logging.exception(
+                "Cannot create message or receipt file " + msgPath + nr)
+            self.abortUpload(upload)
+            return ["", ""]
+
+        self.messageLanded(src, dst, src + "_" + nr)
+        return [src + "_" + nr, dst + "_" + nr]
+
+    def abortUpload(self, upload):
+        self.uploads.pop(upload, None)
+
+        for part in ['msg', 'copy']:
+            path = self.uploadFile(upload, part)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def readReceiptFile(self, uid, name):
+        path = os.path.join(self.userReceiptBox(uid), name)
+
+        if not os.path.exists(path):
+            return self.receiptArchive(uid).read(name)
+
+        return self.readFromFile(self.entryFile(path))
 
     def recvMessage(self, uid, msg):
         uid = str(uid)
@@ -236,7 +761,7 @@ class ServerRegistry:
                 "Internal error, wrong message file name format!")
             sys.exit(2)
 
-        result.extend(matches.group(1))
+        result.append(matches.group(1))
 
         try:
             result.append(self.readMsgFile(uid, msg))
@@ -246,6 +771,37 @@ class ServerRegistry:
 
         return result
 
+    def recvMessages(self, uid, msgs, size):
+        """Read the first chunk of several messages, marking all of them
+        as read at once.
+        Returns a list of (sender, chunk, total) per message, with None for
+        the messages that could not be read.
+        """
+        result = []
+        read = []
+
+        for msg in msgs:
+            matches = re.fullmatch("_?([0-9]+)_[0-9]+", str(msg))
+            if not matches:
+                logger.log(logging.ERROR, "Invalid message name: %r" % msg)
+                result.append(None)
+                continue
+
+            try:
+                chunk, total = self.readMsgChunk(uid, msg, 0, size, mark=False)
+            except:
+                logging.exception("Cannot read message " + str(msg) +
+                                  " from user " + str(uid))
+                result.append(None)
+                continue
+
+            result.append((matches.group(1), chunk, total))
+            read.append(self.messageName(msg))
+
+        self.markRead(uid, read)
+
+        return result
+
     def userMessageBox(self, uid):
         return os.path.join(MBOXES_PATH, str(uid))
 
@@ -253,7 +809,7 @@ class ServerRegistry:
         return os.path.join(RECEIPTS_PATH, str(uid))
 
     def storeReceipt(self, uid, msg, receipt):
-        pattern = re.compile("_?([0-9]+)_([0-9])")
+        pattern = re.compile("_?([0-9]+)_([0-9]+)")
         m = pattern.match(msg)
 
         if not m:
@@ -268,35 +824,172 @@ class ServerRegistry:
             self.saveOnFile(path, receipt)
         except:
             logging.exception("Cannot create receipt file " + path)
+            return
+
+        self.recordChange(m.group(1), 'receipt', "%s_%s" % (uid, m.group(2)))
 
     def getReceipts(self, uid, msg):
+        return self.getAllReceipts(uid, [msg])[msg]
 
-        pattern = re.compile("_(([0-9])+_[0-9])_([0-9]+)")
+    def getAllReceipts(self, uid, msgs):
+        """Get the copies and receipts of several sent messages, with a
+        single pass over the receipt box.
+        """
+        pattern = re.compile("_(([0-9]+)_[0-9]+)_([0-9]+)$")
         boxdir = self.userReceiptBox(uid)
         result = {}
-        copy = ""
 
-        try:
-            path = os.path.join(self.userReceiptBox(uid), msg)
-            copy = self.readFromFile(path)
-        except:
-            logging.exception("Cannot read a copy file")
-            copy = ""
+        for msg in msgs:
+            try:
+                copy = self.readReceiptFile(uid, msg)
+            except:
+                logging.exception("Cannot read a copy file")
+                copy = ""
 
-        result = {"msg": copy, "receipts": []}
+            result[msg] = {"msg": copy, "receipts": []}
 
-        for fname in os.listdir(boxdir):
+        fnames = set(os.listdir(boxdir)) | set(self.receiptArchive(uid).names())
+        for fname in sorted(fnames):
             m = pattern.match(fname)
-            if m and m.group(1) == msg:
-                path = os.path.join(self.userReceiptBox(uid), fname)
+            if m and m.group(1) in result:
                 try:
-                    receiptText = self.readFromFile(path)
+                    receiptText = self.readReceiptFile(uid, fname)
                 except:
                     logging.exception("Cannot read a receipt file")
                     receiptText = ""
 
                 receipt = {
                     "date": m.group(3), "id": m.group(2), "receipt": receiptText}
-                result['receipts'].append(receipt)
+                result[m.group(1)]['receipts'].append(receipt)
 
         return result
+
+    def compactStep(self):
+        """Apply the retention policy to the next users, round robin, until
+        the work of a step is done or COMPACT_MAX_TIME has passed.
+        Called periodically by the server, so that each call does a bounded
+        amount of work. Users with more to archive than a step can do are
+        compacted again by the next steps.
+        """
+        uids = sorted(self.users.keys())
+        if not uids:
+            return
+
+        budget = {'entries': COMPACT_MAX_ENTRIES, 'bytes': COMPACT_MAX_BYTES}
+        deadline = time.time() + COMPACT_MAX_TIME
+
+        # Each user is visited at most once per step
+        uids = [u for u in uids if u > self.compactCursor] \
+            + [u for u in uids if u <= self.compactCursor]
+        for uid in uids:
+            try:
+                if self.compactUser(uid, budget):
+                    return
+            except:
+                logging.exception("Cannot compact mailbox of user %d" % uid)
+
+            self.compactCursor = uid
+
+            if budget['entries'] <= 0 or budget['bytes'] <= 0 \
+                    or time.time() >= deadline:
+                return
+
+    def takeFiles(self, groups, budget):
+        """Files of as many groups (lists of (name, path)) as fit in the
+        budget of a compaction step, which is updated. At least one group
+        is taken.
+        Returns the files and whether any group was left out.
+        """
+        files = {}
+        for group in groups:
+            size = sum(os.path.getsize(path) for name, path in group)
+            if files and (budget['entries'] < len(group)
+                          or budget['bytes'] < size):
+                return files, True
+
+            files.update(group)
+            budget['entries'] -= len(group)
+            budget['bytes'] -= size
+
+        return files, False
+
+    def compactUser(self, uid, budget=None):
+        """Archive what the retention policy of a user allows, up to the
+        work left in the budget of a compaction step, which is updated.
+        Returns whether there is still more to archive.
+        """
+        retention = self.retentionFor(uid)
+        if retention is None:
+            return False
+
+        deadline = time.time() - retention
+        if budget is None:
+            budget = {'entries': COMPACT_MAX_ENTRIES,
+                      'bytes': COMPACT_MAX_BYTES}
+
+        # Read messages older than the retention threshold
+        mailbox = self.mailbox(uid)
+        boxdir = self.userMessageBox(uid)
+        groups = []
+        for msg in self.userMessages(boxdir, "[0-9]+_[0-9]+$"):
+            path = os.path.join(boxdir, msg)
+            if mailbox.isRead(msg) and os.path.getmtime(path) < deadline:
+                groups.append([(msg, path)])
+
+        files, more = self.takeFiles(groups, budget)
+        self.archiveFiles(self.messageArchive(uid), files, budget)
+        if files:
+            mailbox.forget(list(files.keys()))
+        if more:
+            return True
+
+        # Sent message copies older than the threshold, with their receipts
+        pattern = re.compile("_(([0-9]+)_[0-9]+)_([0-9]+)$")
+        boxdir = self.userReceiptBox(uid)
+        fnames = os.listdir(boxdir) if os.path.exists(boxdir) else []
+        groups = {}
+        for copy in fnames:
+            path = os.path.join(boxdir, copy)
+            if re.match("[0-9]+_[0-9]+$", copy) \
+                    and os.path.getmtime(path) < deadline:
+                groups[copy] = [(copy, path)]
+
+        # Receipts go along with their copy
+        archive = self.receiptArchive(uid)
+        for fname in fnames:
+            m = pattern.match(fname)
+            path = os.path.join(boxdir, fname)
+            if not m:
+                continue
+
+            if m.group(1) in groups:
+                groups[m.group(1)].append((fname, path))
+            elif archive.contains(m.group(1)) \
+                    and os.path.getmtime(path) < deadline:
+                groups[fname] = [(fname, path)]
+
+        files, more = self.takeFiles(groups.values(), budget)
+        self.archiveFiles(archive, files, budget)
+        return more
+
+    def archiveFiles(self, archive, files, budget):
+        if not files:
+            return
+
+        # Shared bodies are copied into the pack, releasing the reference
+        entries = {}
+        for name in files:
+            entries[name] = self.readFromFile(self.entryFile(files[name]))
+
+        archive.store(entries)
+
+        for name in files:
+            try:
+                os.remove(files[name])
+            except:
+                logging.exception("Cannot remove archived file " + files[name])
+
+        self.releaseSharedEntries(files.values())
+
+        # Merging packs takes from the same budget
+        budget['bytes'] -= archive.merge(max(budget['bytes'], 0))
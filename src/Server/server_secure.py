@@ -3,10 +3,14 @@ from log import logger
 from cryptography.exceptions import *
 from OpenSSL import crypto
 import os
+from collections import OrderedDict
 import base64
 import json
 import logging
 
+# Number of server key pairs that sequenced requests may refer to
+MAX_SERVER_KEYS = 64
+
 
 class ServerSecure:
 
@@ -25,6 +29,17 @@ class ServerSecure:
         self.prev_mac = None
         self.nonce = None
 
+        # Sequenced requests, which may be pipelined
+        self.server_keys = OrderedDict()
+        self.request_seq = 0
+        self.response_seq = 0
+        self.current_request = {'rid': None}
+
+        # Event channel, independent from the request/response chain
+        self.event_peer_pub_value = None
+        self.event_peer_salt = None
+        self.event_prev_mac = None
+
         self.private_key = certs.priv_key
         self.public_key = certs.pub_key
 
@@ -83,13 +98,27 @@ class ServerSecure:
             sent_payload['secdata']['salt'].encode())
         self.number_of_hash_derivations = sent_payload['secdata']['index']
         self.nonce = base64.b64decode(sent_payload['nonce'].encode())
+        self.current_request = {'rid': None}
 
         return {'type': 'init', 'uuid': self.uuid}
 
-    def encapsulate_secure_message(self, payload):
+    def remember_server_key(self, salt, priv_value):
+        """Keep the latest server key pairs, identified by their salt,
+        so sequenced requests can be ciphered with any recent one.
+        """
+        self.server_keys[base64.b64encode(salt).decode()] = priv_value
+        while len(self.server_keys) > MAX_SERVER_KEYS:
+            self.server_keys.popitem(last=False)
+
+    def encapsulate_secure_message(self, payload, request=None):
+        # Answer sequenced requests with a sequenced response
+        if request is not None and request['rid'] is not None:
+            return self.encapsulate_sequenced_message(payload, request)
+
         # Values used in key exchange
         self.salt = os.urandom(16)
         self.priv_value, self.pub_value = generate_ecdh_keypair()
+        self.remember_server_key(self.salt, self.priv_value)
 
         # Derive AES key and cipher payload
         aes_key = derive_key_from_ecdh(
@@ -166,6 +195,171 @@ class ServerSecure:
 
         return message
 
+    def encapsulate_sequenced_message(self, payload, request):
+        # Fresh values for each response, the chain values are not touched
+        salt = os.urandom(16)
+        priv_value, pub_value = generate_ecdh_keypair()
+        self.remember_server_key(salt, priv_value)
+
+        aes_key = derive_key_from_ecdh(
+            priv_value,
+            request['dhpubvalue'],
+            salt,
+            request['salt'],
+            self.cipher_suite['aes']['key_size'],
+            self.cipher_suite['sha']['size'],
+            1,
+        )
+
+        aes_cipher, aes_iv = generate_aes_cipher(
+            aes_key, self.cipher_suite['aes']['mode'])
+
+        encryptor = aes_cipher.encryptor()
+        ciphered_payload = encryptor.update(json.dumps(payload).encode())\
+                           + encryptor.finalize()
+
+        # Request id and sequence number are covered by the MAC
+        self.response_seq += 1
+        message_payload = base64.b64encode(json.dumps({
+            'message': base64.b64encode(ciphered_payload).decode(),
+            'secdata': {
+                'dhpubvalue': serialize_key(pub_value),
+                'salt': base64.b64encode(salt).decode(),
+                'iv': base64.b64encode(aes_iv).decode(),
+                'index': 1,
+                'rid': request['rid'],
+                'seq': self.response_seq
+            }
+        }).encode())
+
+        # Bound to the session by the client nonce instead of a MAC chain
+        mac = base64.b64encode(generate_mac(
+            aes_key,
+            message_payload + self.nonce,
+            self.cipher_suite['sha']['size']
+        ))
+
+        message = {
+            'type': 'secure',
+            'payload': message_payload.decode(),
+            'mac': mac.decode(),
+            'cipher_spec': self.cipher_spec
+        }
+
+        logger.log(logging.DEBUG, "SEQUENCED MESSAGE SENT: %r" % message)
+
+        return message
+
+    def uncapsulate_sequenced_message(self, message, payload):
+        secdata = payload['secdata']
+
+        # Requests arrive in order, anything else is a replay or a drop
+        if secdata['seq'] != self.request_seq + 1:
+            return {'type': 'error', 'error': "Invalid sequence number; "
+                                              "dropping message"}
+
+        if secdata['peer_salt'] not in self.server_keys:
+            return {'type': 'error', 'error': "Unknown server key; "
+                                              "dropping message"}
+
+        peer_pub_value = deserialize_key(secdata['dhpubvalue'])
+        peer_salt = base64.b64decode(secdata['salt'].encode())
+
+        aes_key = derive_key_from_ecdh(
+            self.server_keys[secdata['peer_salt']],
+            peer_pub_value,
+            peer_salt,
+            base64.b64decode(secdata['peer_salt'].encode()),
+            self.cipher_suite['aes']['key_size'],
+            self.cipher_suite['sha']['size'],
+            1,
+        )
+
+        # Verify MAC to make sure of message integrity
+        if not verify_mac(aes_key, message['payload'].encode() + self.nonce,
+                          base64.b64decode(message['mac'].encode()),
+                          self.cipher_suite['sha']['size']):
+            return {'type': 'error', 'error': "Invalid MAC; dropping message"}
+
+        self.request_seq = secdata['seq']
+        self.current_request = {
+            'rid': secdata['rid'],
+            'dhpubvalue': peer_pub_value,
+            'salt': peer_salt
+        }
+
+        # Decipher payload
+        aes_cipher, aes_iv = generate_aes_cipher(
+            aes_key,
+            self.cipher_suite['aes']['mode'],
+            base64.b64decode(secdata['iv'].encode())
+        )
+
+        decryptor = aes_cipher.decryptor()
+        return_payload = decryptor.update(base64.b64decode(
+            payload['message'].encode())) + decryptor.finalize()
+
+        return json.loads(return_payload.decode())
+
+    def setup_event_channel(self, secdata):
+        """Keep the values sent by the client in a subscription, used to
+        cipher events pushed outside of the request/response chain.
+        """
+        self.event_peer_pub_value = deserialize_key(secdata['dhpubvalue'])
+        self.event_peer_salt = base64.b64decode(secdata['salt'].encode())
+        self.event_prev_mac = base64.b64decode(secdata['nonce'].encode())
+
+    def encapsulate_event_message(self, payload):
+        # Fresh values for each event, so the request chain is not touched
+        salt = os.urandom(16)
+        priv_value, pub_value = generate_ecdh_keypair()
+
+        aes_key = derive_key_from_ecdh(
+            priv_value,
+            self.event_peer_pub_value,
+            salt,
+            self.event_peer_salt,
+            self.cipher_suite['aes']['key_size'],
+            self.cipher_suite['sha']['size'],
+            1,
+        )
+
+        aes_cipher, aes_iv = generate_aes_cipher(
+            aes_key, self.cipher_suite['aes']['mode'])
+
+        encryptor = aes_cipher.encryptor()
+        ciphered_payload = encryptor.update(json.dumps(payload).encode())\
+                           + encryptor.finalize()
+
+        message_payload = base64.b64encode(json.dumps({
+            'message': base64.b64encode(ciphered_payload).decode(),
+            'secdata': {
+                'dhpubvalue': serialize_key(pub_value),
+                'salt': base64.b64encode(salt).decode(),
+                'iv': base64.b64encode(aes_iv).decode()
+            }
+        }).encode())
+
+        # Events are chained among themselves
+        mac = base64.b64encode(generate_mac(
+            aes_key,
+            message_payload + self.event_prev_mac,
+            self.cipher_suite['sha']['size']
+        ))
+
+        self.event_prev_mac = mac
+
+        message = {
+            'type': 'event',
+            'payload': message_payload.decode(),
+            'mac': mac.decode(),
+            'cipher_spec': self.cipher_spec
+        }
+
+        logger.log(logging.DEBUG, "EVENT MESSAGE SENT: %r" % message)
+
+        return message
+
     def uncapsulate_secure_message(self, message):
         logger.log(logging.DEBUG, "SECURE MESSAGE RECEIVED: %r" % message)
 
@@ -181,6 +375,9 @@ class ServerSecure:
         payload = json.loads(base64.b64decode(
             message['payload'].encode()).decode())
 
+        if 'seq' in payload['secdata']:
+            return self.uncapsulate_sequenced_message(message, payload)
+
         # Derive AES key and decipher payload
         self.number_of_hash_derivations = payload['secdata']['index']
 
@@ -206,6 +403,7 @@ class ServerSecure:
             return {'type': 'error', 'error': "Invalid MAC; dropping message"}
 
         self.prev_mac = message['mac'].encode()
+        self.current_request = {'rid': None}
 
         # Decipher payload
         aes_cipher, aes_iv = generate_aes_cipher(
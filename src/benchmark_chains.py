@@ -0,0 +1,98 @@
+"""Benchmark of issuer lookups and chain building over the CA certificates
+bundled with the server.
+
+Times loading and indexing the certificates in Server/certs, finding the
+issuer of each of them through the CA index, and building their chains up
+to the root, with and without the cached chains.
+
+The bundled certificates have all expired, and checking their revocation
+status needs the CA endpoints, so chains are built with the expiration and
+revocation checks of each certificate taken as passed. What is measured
+is the path building itself.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'Server'))
+
+import lib
+from certificates import X509Certificates
+
+
+def load_certificates():
+    # Files the certificates keep are written apart, not in the server ones
+    directory = tempfile.mkdtemp()
+    lib.USER_CERTS_DIR = os.path.join(directory, 'users', '')
+    lib.CRLS_DIR = os.path.join(directory, 'crls', '')
+    lib.CRLS_INDEX = lib.CRLS_DIR + 'index.json'
+    lib.VALIDATION_CACHE = os.path.join(directory, 'validation.json')
+    lib.CERT_WARMUP_WORKERS = 0
+
+    start = time.time()
+    certs = X509Certificates({})
+    return certs, time.time() - start
+
+
+def report(name, count, elapsed):
+    print("%-28s %8d in %8.4fs  %12.0f/s" %
+          (name, count, elapsed, count / elapsed if elapsed else 0))
+
+
+def bench_issuers(certs, rounds):
+    cas = list(certs.ca_certs.values())
+
+    start = time.time()
+    for i in range(rounds):
+        found = [certs.find_issuer(ca) for ca in cas]
+    report("issuer lookups", rounds * len(cas), time.time() - start)
+
+    resolved = len([issuer for issuer in found if issuer is not None])
+    print("%d of %d CA certificates have their issuer bundled" %
+          (resolved, len(cas)))
+
+
+def bench_chains(certs, rounds):
+    certs.check_expiration_or_revoked = lambda cert_entry: True
+    certs.chain_expiry = lambda chain: time.time() + lib.VALIDATION_TTL
+
+    cas = [ca for ca in certs.ca_certs.values()
+           if certs.find_issuer(ca) is not None]
+
+    start = time.time()
+    for i in range(rounds):
+        certs.ca_chains = {}
+        chains = [certs.get_ca_chain(ca) for ca in cas]
+    report("chains built", rounds * len(cas), time.time() - start)
+
+    start = time.time()
+    for i in range(rounds):
+        chains = [certs.get_ca_chain(ca) for ca in cas]
+    report("chains from cache", rounds * len(cas), time.time() - start)
+
+    lengths = [len(chain) + 1 for chain in chains if chain is not None]
+    print("%d chains, up to %d certificates long" %
+          (len(lengths), max(lengths, default=0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=1000,
+                        help="times each lookup is repeated")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    certs, elapsed = load_certificates()
+    report("CA certificates loaded", len(certs.ca_certs), elapsed)
+
+    bench_issuers(certs, args.rounds)
+    bench_chains(certs, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
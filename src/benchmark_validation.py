@@ -0,0 +1,209 @@
+"""Benchmark of user certificate validations with many user certificates.
+
+Generates a root and an intermediate CA, both with a CRL, and as many user
+certificates as requested, which are kept as the server keeps the ones of
+its users. Then times validating them, first with nothing cached and then
+from the validation cache, and compares with building a store with every
+known certificate for each validation, as it was done before the long-lived
+store of CA certificates.
+"""
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from datetime import datetime, timedelta
+from OpenSSL import crypto
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'Server'))
+
+import lib
+from certificates import X509Certificates
+
+
+def name(common_name, serial=None):
+    attributes = [x509.NameAttribute(NameOID.COMMON_NAME, common_name)]
+    if serial is not None:
+        attributes.append(x509.NameAttribute(NameOID.SERIAL_NUMBER, serial))
+
+    return x509.Name(attributes)
+
+
+def build_cert(subject, key, issuer, issuer_key, ca):
+    now = datetime.utcnow()
+    builder = x509.CertificateBuilder() \
+        .subject_name(subject) \
+        .issuer_name(issuer.subject if issuer is not None else subject) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - timedelta(days=1)) \
+        .not_valid_after(now + timedelta(days=365)) \
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=None),
+                       critical=True) \
+        .add_extension(x509.KeyUsage(
+            digital_signature=not ca, content_commitment=False,
+            key_encipherment=False, data_encipherment=False,
+            key_agreement=False, key_cert_sign=ca, crl_sign=ca,
+            encipher_only=False, decipher_only=False), critical=True) \
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(
+            key.public_key()), critical=False)
+
+    if issuer is not None:
+        builder = builder.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                issuer_key.public_key()), critical=False)
+
+    return builder.sign(issuer_key if issuer is not None else key,
+                        hashes.SHA256(), default_backend())
+
+
+def build_crl(issuer, issuer_key, revoked):
+    now = datetime.utcnow()
+    builder = x509.CertificateRevocationListBuilder() \
+        .issuer_name(issuer.subject) \
+        .last_update(now) \
+        .next_update(now + timedelta(days=1))
+
+    for serial in revoked:
+        builder = builder.add_revoked_certificate(
+            x509.RevokedCertificateBuilder()
+            .serial_number(serial)
+            .revocation_date(now)
+            .build(default_backend()))
+
+    crl = builder.sign(issuer_key, hashes.SHA256(), default_backend())
+    return crypto.load_crl(crypto.FILETYPE_ASN1,
+                           crl.public_bytes(serialization.Encoding.DER))
+
+
+def load_certificates(users, revoked):
+    """Certificates with a CA hierarchy and the given number of saved user
+    certificates. Returns them along with the user certificates.
+    """
+    # Files the certificates keep are written apart, not in the server ones
+    directory = tempfile.mkdtemp()
+    lib.CERTS_DIR = os.path.join(directory, 'certs', '')
+    lib.USER_CERTS_DIR = os.path.join(directory, 'users', '')
+    lib.CRLS_DIR = os.path.join(directory, 'crls', '')
+    lib.CRLS_INDEX = lib.CRLS_DIR + 'index.json'
+    lib.VALIDATION_CACHE = os.path.join(directory, 'validation.json')
+    lib.CERT_WARMUP_WORKERS = 0
+
+    certs = X509Certificates({})
+
+    root_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    root = build_cert(name("Benchmark Root"), root_key, None, None, True)
+    ca_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    ca = build_cert(name("Benchmark CA"), ca_key, root, root_key, True)
+
+    crls = {}
+    for cert, key, serials in [(root, root_key, []),
+                               (ca, ca_key, range(1, revoked + 1))]:
+        cert = crypto.X509.from_cryptography(cert)
+        cert_id = X509Certificates.get_cert_id(cert)
+        certs.certs[cert_id] = {'cert': cert, 'path': None}
+        certs.add_ca_cert(cert_id, cert)
+
+        entry = X509Certificates.crl_entry(build_crl(
+            cert.to_cryptography(), key, serials), None)
+        entry['urls'] = {'crl': None, 'delta': None}
+        entry['delta'] = None
+        crls[cert_id] = entry
+
+    with certs.lock:
+        certs.crls = crls
+        certs.store = None
+
+    # Users have their own certificate, not their own key
+    user_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    user_certs = []
+    for i in range(users):
+        cert = crypto.X509.from_cryptography(build_cert(
+            name("User %d" % i, "BI%08d" % i), user_key, ca, ca_key, False))
+        certs.certs[X509Certificates.get_cert_id(cert)] = \
+            {'cert': cert, 'path': None}
+        user_certs.append(cert)
+
+    return certs, user_certs
+
+
+def report(name, count, elapsed):
+    print("%-34s %8d in %8.3fs  %10.1f/s" %
+          (name, count, elapsed, count / elapsed if elapsed else 0))
+
+
+def bench_validations(certs, user_certs):
+    start = time.time()
+    valid = [certs.validate_cert(cert) for cert in user_certs]
+    report("validations", len(user_certs), time.time() - start)
+
+    if not all(valid):
+        print("%d certificates were not valid" % valid.count(False))
+
+    start = time.time()
+    for cert in user_certs:
+        certs.validate_cert(cert)
+    report("validations from cache", len(user_certs), time.time() - start)
+
+
+def bench_store_per_validation(certs, user_certs, limit):
+    """Validations building a store with every known certificate and CRL
+    each time, as before. Their cost grows faster than the number of
+    certificates, so they are timed with more and more user certificates,
+    until one takes longer than limit seconds.
+    """
+    known = [entry['cert'] for entry in certs.certs.values()]
+    size = 1000
+    while True:
+        size = min(size, len(known))
+
+        start = time.time()
+        store = crypto.X509Store()
+        store.set_flags(crypto.X509StoreFlags.CRL_CHECK_ALL)
+        for cert in known[:size]:
+            store.add_cert(cert)
+        for entry in certs.crls.values():
+            store.add_crl(entry['crl'])
+
+        crypto.X509StoreContext(store, user_certs[0]).verify_certificate()
+        elapsed = time.time() - start
+        report("validation, store of %d certs" % size, 1, elapsed)
+
+        if size == len(known) or elapsed > limit:
+            break
+        size *= 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=100000,
+                        help="user certificates kept by the server")
+    parser.add_argument('--validations', type=int, default=10000,
+                        help="user certificates validated")
+    parser.add_argument('--limit', type=float, default=10,
+                        help="seconds a validation building its own store "
+                        "may take before larger stores are not tried")
+    parser.add_argument('--revoked', type=int, default=1000,
+                        help="revoked serial numbers in the CRL of the CA")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    start = time.time()
+    certs, user_certs = load_certificates(args.users, args.revoked)
+    print("Generated %d user certificates in %.1fs" %
+          (len(user_certs), time.time() - start))
+
+    bench_validations(certs, user_certs[:args.validations])
+    bench_store_per_validation(certs, user_certs, args.limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,4 +5,7 @@ rm -rf Client/certs/users
 
 rm -rf Server/mboxes
 rm -rf Server/receipts
+rm -rf Server/archives
+rm -rf Server/uploads
+rm -rf Server/bodies
 rm -rf Server/certs/users
@@ -0,0 +1,244 @@
+"""Check of the revocation fetch policies against a fake CRL endpoint.
+
+Serves a CRL from a local HTTP endpoint that can be made slow or failing,
+and checks that the server certificates time out on it, skip it while it
+keeps failing and try it again after a while (circuit breaker), and either
+use the CRL they already have or reject certificates, as the revocation
+policy says.
+
+The CRL served is past its next update, so it is always fetched again,
+and only used as long as the policy allows it.
+"""
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timedelta
+from OpenSSL import crypto
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'Server'))
+
+import lib
+from certificates import X509Certificates
+
+
+class FakeEndpointHandler(BaseHTTPRequestHandler):
+    crl = b''
+    delay = 0
+    status = 200
+    requests = 0
+
+    def do_GET(self):
+        FakeEndpointHandler.requests += 1
+        time.sleep(self.delay)
+
+        try:
+            self.send_response(self.status)
+            if self.status != 200:
+                self.end_headers()
+                return
+
+            self.send_header('Content-Type', 'application/pkix-crl')
+            self.send_header('Content-Length', str(len(self.crl)))
+            self.end_headers()
+            self.wfile.write(self.crl)
+        except ConnectionError:
+            # The client gave up waiting
+            pass
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def build_hierarchy(url):
+    """Certificate issued by a CA pointing to url for its CRL, and the CRL
+    of the CA, past its next update.
+    """
+    now = datetime.utcnow()
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Fake CA")])
+
+    ca = x509.CertificateBuilder() \
+        .subject_name(ca_name) \
+        .issuer_name(ca_name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - timedelta(days=1)) \
+        .not_valid_after(now + timedelta(days=365)) \
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None),
+                       critical=True) \
+        .sign(key, hashes.SHA256(), default_backend())
+
+    cert = x509.CertificateBuilder() \
+        .subject_name(x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, "Fake User")])) \
+        .issuer_name(ca_name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - timedelta(days=1)) \
+        .not_valid_after(now + timedelta(days=365)) \
+        .add_extension(x509.CRLDistributionPoints([x509.DistributionPoint(
+            [x509.UniformResourceIdentifier(url)], None, None, None)]),
+            critical=False) \
+        .sign(key, hashes.SHA256(), default_backend())
+
+    crl = x509.CertificateRevocationListBuilder() \
+        .issuer_name(ca_name) \
+        .last_update(now - timedelta(days=1)) \
+        .next_update(now - timedelta(hours=1)) \
+        .sign(key, hashes.SHA256(), default_backend())
+
+    return (crypto.X509.from_cryptography(cert),
+            crl.public_bytes(serialization.Encoding.DER))
+
+
+def load_certificates():
+    # Files the certificates keep are written apart, not in the server ones
+    directory = tempfile.mkdtemp()
+    lib.CERTS_DIR = os.path.join(directory, 'certs', '')
+    lib.USER_CERTS_DIR = os.path.join(directory, 'users', '')
+    lib.CRLS_DIR = os.path.join(directory, 'crls', '')
+    lib.CRLS_INDEX = lib.CRLS_DIR + 'index.json'
+    lib.VALIDATION_CACHE = os.path.join(directory, 'validation.json')
+    lib.CERT_WARMUP_WORKERS = 0
+    lib.OCSP_URL = None
+
+    return X509Certificates({})
+
+
+class Checks:
+    def __init__(self, certs):
+        self.certs = certs
+        self.failed = 0
+
+    def check(self, description, passed):
+        print("%-4s %s" % ('ok' if passed else 'FAIL', description))
+        if not passed:
+            self.failed += 1
+
+    def stats(self):
+        with self.certs.lock:
+            return dict(self.certs.revocation_stats)
+
+    def fetch(self, url):
+        """Fetch a CRL, returning the outcomes counted for it, whether the
+        endpoint was requested, and the CRL, or None if it was rejected.
+        """
+        before = self.stats()
+        requests = FakeEndpointHandler.requests
+
+        try:
+            crl, path = self.certs.fetch_crl(url)
+        except Exception:
+            crl = None
+
+        after = self.stats()
+        outcomes = [outcome for outcome in after
+                    if after[outcome] != before.get(outcome, 0)]
+        return outcomes, FakeEndpointHandler.requests != requests, crl
+
+
+def run_checks(certs, url, cert, cooldown):
+    checks = Checks(certs)
+    entry = {'cert': cert}
+
+    FakeEndpointHandler.status = 200
+    outcomes, requested, crl = checks.fetch(url)
+    checks.check("fetches the CRL from a healthy endpoint",
+                 requested and crl is not None and 'fetched' in outcomes)
+    checks.check("accepts a certificate with an outdated CRL within the "
+                 "stale grace", certs.check_expiration_or_revoked(entry))
+
+    FakeEndpointHandler.delay = lib.REVOCATION_TIMEOUTS[
+        url.split('/')[2]] * 2
+    start = time.time()
+    outcomes, requested, crl = checks.fetch(url)
+    checks.check("gives up on a slow endpoint after its timeout",
+                 time.time() - start < FakeEndpointHandler.delay
+                 and 'fetch_error' in outcomes)
+    checks.check("serves the cached CRL when the endpoint times out",
+                 crl is not None and 'served_stale' in outcomes)
+
+    FakeEndpointHandler.delay = 0
+    FakeEndpointHandler.status = 500
+    for i in range(lib.BREAKER_FAILURES - 1):
+        outcomes, requested, crl = checks.fetch(url)
+    checks.check("serves the cached CRL when the endpoint fails",
+                 requested and crl is not None and 'served_stale' in outcomes)
+
+    outcomes, requested, crl = checks.fetch(url)
+    checks.check("skips the endpoint after %d failures in a row"
+                 % lib.BREAKER_FAILURES,
+                 not requested and 'breaker_open' in outcomes
+                 and crl is not None)
+
+    time.sleep(cooldown)
+    outcomes, requested, crl = checks.fetch(url)
+    checks.check("tries the endpoint again after the cooldown", requested)
+    outcomes, requested, crl = checks.fetch(url)
+    checks.check("skips it again when that try fails",
+                 not requested and 'breaker_open' in outcomes)
+
+    time.sleep(cooldown)
+    FakeEndpointHandler.status = 200
+    outcomes, requested, crl = checks.fetch(url)
+    outcomes_after, requested_after, crl = checks.fetch(url)
+    checks.check("uses the endpoint again once a try succeeds",
+                 requested and 'fetched' in outcomes and requested_after)
+
+    lib.REVOCATION_POLICY = 'fail-closed'
+    checks.check("rejects a certificate with an outdated CRL when failing "
+                 "closed", not certs.check_expiration_or_revoked(entry))
+
+    FakeEndpointHandler.status = 500
+    outcomes, requested, crl = checks.fetch(url)
+    checks.check("rejects the cached CRL when the endpoint fails and "
+                 "failing closed", crl is None and 'failed_closed' in outcomes)
+
+    print("Revocation checks: %r" % checks.stats())
+    return checks.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--timeout', type=float, default=0.5,
+                        help="seconds to wait for the fake endpoint")
+    parser.add_argument('--cooldown', type=float, default=1,
+                        help="seconds the fake endpoint is skipped for")
+    parser.add_argument('--port', type=int, default=0,
+                        help="port of the fake endpoint, any free one if 0")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port),
+                                 FakeEndpointHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    host = '127.0.0.1:%d' % server.server_address[1]
+    url = 'http://%s/ca.crl' % host
+    cert, FakeEndpointHandler.crl = build_hierarchy(url)
+
+    lib.REVOCATION_TIMEOUTS[host] = args.timeout
+    lib.BREAKER_COOLDOWN = args.cooldown
+    lib.REVOCATION_POLICY = 'stale'
+
+    failed = run_checks(load_certificates(), url, cert, args.cooldown)
+    server.shutdown()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
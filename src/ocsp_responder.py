@@ -0,0 +1,130 @@
+"""Minimal OCSP responder, to check certificates offline.
+
+Answers for the certificates found in a directory, signing the responses
+with the key of their issuer. Certificates whose serial number is given
+with --revoked are reported as revoked, all others as good.
+"""
+from cryptography import x509
+from cryptography.x509 import ocsp
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timedelta
+import argparse
+import logging
+import os
+
+
+def load_certificate(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    try:
+        return x509.load_pem_x509_certificate(data, default_backend())
+    except ValueError:
+        return x509.load_der_x509_certificate(data, default_backend())
+
+
+def load_certificates(directory):
+    certs = {}
+    for f_name in os.listdir(directory):
+        path = os.path.join(directory, f_name)
+        if os.path.isdir(path):
+            continue
+
+        try:
+            cert = load_certificate(path)
+        except ValueError:
+            logging.debug("Unable to load certificate: %r" % f_name)
+            continue
+
+        certs[cert.serial_number] = cert
+
+    return certs
+
+
+class OCSPHandler(BaseHTTPRequestHandler):
+    issuer = None
+    key = None
+    certs = {}
+    revoked = set()
+    validity = 60 * 60
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+
+        try:
+            request = ocsp.load_der_ocsp_request(self.rfile.read(length))
+        except ValueError:
+            response = ocsp.OCSPResponseBuilder.build_unsuccessful(
+                ocsp.OCSPResponseStatus.MALFORMED_REQUEST)
+        else:
+            response = self.build_response(request)
+
+        data = response.public_bytes(serialization.Encoding.DER)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/ocsp-response')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def build_response(self, request):
+        cert = self.certs.get(request.serial_number)
+        if cert is None:
+            logging.info("Unknown certificate: %d" % request.serial_number)
+            return ocsp.OCSPResponseBuilder.build_unsuccessful(
+                ocsp.OCSPResponseStatus.UNAUTHORIZED)
+
+        now = datetime.utcnow()
+        revoked = request.serial_number in self.revoked
+        logging.info("Certificate %d is %s" %
+                     (request.serial_number, 'revoked' if revoked else 'good'))
+
+        builder = ocsp.OCSPResponseBuilder().add_response(
+            cert=cert,
+            issuer=self.issuer,
+            algorithm=hashes.SHA1(),
+            cert_status=ocsp.OCSPCertStatus.REVOKED if revoked
+            else ocsp.OCSPCertStatus.GOOD,
+            this_update=now,
+            next_update=now + timedelta(seconds=self.validity),
+            revocation_time=now if revoked else None,
+            revocation_reason=None
+        ).responder_id(ocsp.OCSPResponderEncoding.HASH, self.issuer)
+
+        return builder.sign(self.key, hashes.SHA256())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--issuer', required=True,
+                        help="issuer certificate (PEM or DER)")
+    parser.add_argument('--key', required=True,
+                        help="issuer private key (PEM)")
+    parser.add_argument('--certs', required=True,
+                        help="directory with the certificates to answer for")
+    parser.add_argument('--revoked', type=int, nargs='*', default=[],
+                        help="serial numbers of revoked certificates")
+    parser.add_argument('--validity', type=int, default=60 * 60,
+                        help="seconds until the next update of a response")
+    parser.add_argument('--port', type=int, default=8888)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    OCSPHandler.issuer = load_certificate(args.issuer)
+    with open(args.key, 'rb') as f:
+        OCSPHandler.key = serialization.load_pem_private_key(
+            f.read(), None, default_backend())
+    OCSPHandler.certs = load_certificates(args.certs)
+    OCSPHandler.revoked = set(args.revoked)
+    OCSPHandler.validity = args.validity
+
+    logging.info("Answering for %d certificates on port %d" %
+                 (len(OCSPHandler.certs), args.port))
+    HTTPServer(('', args.port), OCSPHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()